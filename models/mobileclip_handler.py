@@ -1,12 +1,27 @@
 import base64
 import io
 import json
+import logging
 import os
+import struct
 from PIL import Image
 import sys
 import torch
 from ts.torch_handler.base_handler import BaseHandler
 
+logger = logging.getLogger(__name__)
+
+BINARY_BATCH_MAGIC = b'TPSTRY\x00\x01'
+
+def unpack_images(body):
+    images, offset = [], len(BINARY_BATCH_MAGIC)
+    while offset < len(body):
+        (length,) = struct.unpack_from('>I', body, offset)
+        offset += 4
+        images.append(bytes(body[offset:offset + length]))
+        offset += length
+    return images
+
 class Handler(BaseHandler):
     def __init__(self, **kwargs):
         self._context = None
@@ -38,32 +53,81 @@ class Handler(BaseHandler):
             model_version, pretrained=model_file
         )
         self.tokenizer = mobileclip.get_tokenizer(model_version)
+        input_size = next((
+            t.size for t in getattr(self.preprocess, 'transforms', []) if hasattr(t, 'size')
+        ), 256)
+        self.input_size = input_size if isinstance(input_size, int) else max(input_size)
         self.model.to(self.device)
         self.initialized = True
 
     def handle(self, data, context):
-        json_data = data[0].get('body')
-        if isinstance(json_data, (str, bytes)):
-            json_data = json.loads(json_data)
-
-        response = {}
-        if 'image' in json_data:
-            image_data = base64.b64decode(json_data['image'])
-            image_bytes = io.BytesIO(image_data)
-            image = Image.open(image_bytes).convert('RGB')
-            image_tensor = self.preprocess(image).unsqueeze(0)
-            image_tensor = image_tensor
-            image_features = self.predict_image(image_tensor)
-            response['image'] = image_features.cpu().numpy().tolist()
-
-        if 'text' in json_data:
-            text = json_data['text']
+        # each request may carry a single item or a list of items, and
+        # torchserve dynamic batching may deliver several requests at once.
+        payloads = []
+        for row in data:
+            json_data = row.get('body') or row.get('data')
+            if isinstance(json_data, (bytes, bytearray)) \
+                    and json_data.startswith(BINARY_BATCH_MAGIC):
+                json_data = {'image': unpack_images(json_data)}
+            elif isinstance(json_data, (str, bytes, bytearray)):
+                json_data = json.loads(json_data)
+            payloads.append(json_data)
+
+        images, image_counts = [], []
+        texts, text_counts = [], []
+        for json_data in payloads:
+            image_data = json_data.get('image', [])
+            if isinstance(image_data, str):
+                image_data = [image_data]
+            images.extend(self.decode_image(image) for image in image_data)
+            image_counts.append(len(image_data) if 'image' in json_data else None)
+
+            text = json_data.get('text', [])
             if isinstance(text, str):
                 text = [text]
-            text_features = self.predict_text(text)
-            response['text'] = text_features.cpu().numpy().tolist()
+            texts.extend(text)
+            text_counts.append(len(text) if 'text' in json_data else None)
+
+        # images that failed to decode get a null embedding, so the rest of
+        # the batch, and the requests batched with it, still succeed.
+        image_features = []
+        decoded = [image for image in images if image is not None]
+        if decoded:
+            image_tensor = torch.stack([self.preprocess(image) for image in decoded])
+            features = iter(self.predict_image(image_tensor).cpu().numpy().tolist())
+            image_features = [None if image is None else next(features) for image in images]
+        elif images:
+            image_features = [None] * len(images)
+
+        text_features = []
+        if texts:
+            text_features = self.predict_text(texts).cpu().numpy().tolist()
+
+        responses = []
+        image_offset, text_offset = 0, 0
+        for image_count, text_count in zip(image_counts, text_counts):
+            response = {}
+            if image_count is not None:
+                response['image'] = image_features[image_offset:image_offset + image_count]
+                image_offset += image_count
+            if text_count is not None:
+                response['text'] = text_features[text_offset:text_offset + text_count]
+                text_offset += text_count
+            responses.append({"body": json.dumps(response)})
+
+        return responses
 
-        return [{"body": json.dumps(response)}]
+    def decode_image(self, image_data):
+        try:
+            if isinstance(image_data, str):
+                image_data = base64.b64decode(image_data)
+            image = Image.open(io.BytesIO(image_data))
+            # let jpeg decode straight to roughly the model's input resolution.
+            image.draft('RGB', (self.input_size, self.input_size))
+            return image.convert('RGB')
+        except Exception as decode_error:
+            logger.warning(f'{decode_error=}')
+            return None
 
     def predict_image(self, image):
         with torch.no_grad(), torch.cuda.amp.autocast():
@@ -1,19 +1,97 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, url_for
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, has_request_context, request, jsonify, render_template, send_from_directory, stream_with_context, url_for
+import json
 import hydra
 from omegaconf import DictConfig
 import os
-from os.path import basename, exists, join, splitext
+from os.path import exists, join, splitext
 import pathlib
+from threading import Thread
+import time
+from typing import Dict, List
 import uuid
 from werkzeug.utils import secure_filename
 
+from tapestry.cache import EmbeddingCache, LRUCache
 from tapestry.collection import CollectionManager, register_collection_routes
-from tapestry.database import DatabaseManager
+from tapestry.database import DatabaseManager, federated_search
 from tapestry.dataset import DatasetManager
+from tapestry.events import StatusBroker
+from tapestry.manifest import ImageManifest
+from tapestry.registry import ManagerRegistry
+from tapestry.status import StatusStore
+from tapestry.thumbnails import ThumbnailCache, thumbnail_urls
 
 PROJECT_ROOT = pathlib.Path(__file__).parent.parent.parent
 DATA_DIR = PROJECT_ROOT / 'data'
 
+def build_embedding_cache(cfg: DictConfig, read_only: bool = False) -> EmbeddingCache:
+    if not cfg.embedding_cache_path:
+        return None
+    return EmbeddingCache(
+        cfg.embedding_cache_path,
+        cfg.embedding_model_id or cfg.embedding_model_address,
+        cfg.embedding_dimension,
+        cfg.embedding_cache_dtype,
+        read_only,
+    )
+
+def build_db_manager(
+    cfg: DictConfig,
+    dataset_id: str,
+    dataset,
+    embedding_cache: EmbeddingCache = None,
+    thumbnails: ThumbnailCache = None,
+    auto_initialize: bool = True,
+    text_cache: LRUCache = None,
+    result_cache: LRUCache = None,
+    status_store: StatusStore = None,
+    indexing: bool = True,
+    status_events: StatusBroker = None,
+    snapshots: bool = False,
+    shard: int = None,
+) -> DatabaseManager:
+    return DatabaseManager(
+        {
+            'IMAGE_FOLDER': dataset.image_folder,
+            'UPLOAD_FOLDER': os.path.join(dataset.data_path, 'uploads'),
+            'PROCESSING_STATUS': {
+                'is_processing': False,
+                'processed_count': 0,
+                'total_count': 0
+            }
+        },
+        dataset.db_path,
+        dataset.db_name,
+        cfg.db_meta,
+        cfg.embedding_model_address,
+        cfg.embedding_dimension,
+        cfg.embedding_image_size,
+        cfg.image_extensions,
+        cfg.embedding_batch_size,
+        cfg.embedding_max_in_flight,
+        cfg.timeout,
+        cfg.embedding_transport,
+        embedding_cache,
+        cfg.preprocess_workers,
+        thumbnails,
+        cfg.db_backends.get(dataset_id, cfg.db_backend),
+        cfg.db_vector_dtype,
+        cfg.db_quantization,
+        cfg.db_rerank_factor,
+        cfg.db_shard_counts.get(dataset_id, cfg.db_shards),
+        auto_initialize,
+        text_cache,
+        result_cache,
+        status_store,
+        indexing,
+        cfg.server.reload_interval,
+        status_events,
+        snapshots,
+        int(cfg.embedding_max_request_mb * 2**20) if cfg.embedding_max_request_mb else None,
+        shard,
+    )
+
 def make_app(cfg):
     app = Flask(__name__)
 
@@ -21,40 +99,94 @@ def make_app(cfg):
     app.config['COLLECTIONS_DB'] = str(DATA_DIR / 'collections.db')
 
     dataset_manager = DatasetManager(str(DATA_DIR))
-    db_managers = {}
+    status_store = StatusStore(cfg.status_db_path)
+    # production workers leave indexing to the process started by `tapestry.serve`.
+    indexing = cfg.server.index_owner
+    # the indexing threads push status changes to open progress streams.
+    status_events = StatusBroker()
+
+    # the cache's files have a single writer: the process that owns indexing.
+    embedding_cache = build_embedding_cache(cfg, read_only=not indexing)
+    text_cache = LRUCache(cfg.text_embedding_cache_size)
+    result_cache = LRUCache(cfg.search_cache_size)
 
     collection_manager = CollectionManager(app.config['COLLECTIONS_DB'])
     collection_manager.init_db()
 
-    def get_or_create_db_manager(dataset_id: str) -> DatabaseManager:
-        if dataset_id not in db_managers:
+    thumbnail_executor = None
+    if cfg.thumbnail_sizes:
+        thumbnail_executor = ThreadPoolExecutor(
+            max_workers=cfg.thumbnail_workers,
+            thread_name_prefix='thumbnails',
+        )
+
+    search_executor = ThreadPoolExecutor(
+        max_workers=cfg.search_workers,
+        thread_name_prefix='search',
+    )
+
+    def create_db_manager(dataset_id: str) -> DatabaseManager:
+        dataset = dataset_manager.get_dataset(dataset_id)
+        if not dataset:
+            # the dataset may have been created through another worker.
+            dataset_manager.refresh()
             dataset = dataset_manager.get_dataset(dataset_id)
-            if not dataset:
-                raise ValueError(f'{dataset_id=}')
-
-            db_manager = DatabaseManager(
-                {
-                    'IMAGE_FOLDER': dataset.image_folder,
-                    'UPLOAD_FOLDER': os.path.join(dataset.data_path, 'uploads'),
-                    'PROCESSING_STATUS': {
-                        'is_processing': False,
-                        'processed_count': 0,
-                        'total_count': 0
-                    }
-                },
-                dataset.db_path,
-                dataset.db_name,
-                cfg.db_meta,
-                cfg.embedding_model_address,
-                cfg.embedding_dimension,
-                cfg.embedding_image_size,
-                cfg.image_extensions,
-                cfg.embedding_batch_size,
+        if not dataset:
+            raise ValueError(f'{dataset_id=}')
+
+        thumbnails = None
+        if cfg.thumbnail_sizes:
+            thumbnails = ThumbnailCache(
+                dataset.thumbnail_folder,
+                cfg.thumbnail_sizes,
+                cfg.thumbnail_quality,
+                thumbnail_executor,
             )
-            db_managers[dataset_id] = db_manager
-            init_thread = db_manager.start_initialization()
-            
-        return db_managers[dataset_id]
+
+        db_manager = build_db_manager(
+            cfg,
+            dataset_id,
+            dataset,
+            embedding_cache,
+            thumbnails,
+            text_cache=text_cache,
+            result_cache=result_cache,
+            status_store=status_store,
+            indexing=indexing,
+            status_events=status_events,
+        )
+        if indexing:
+            db_manager.start_initialization()
+            if cfg.sync_interval:
+                db_manager.start_watcher(cfg.sync_interval)
+        return db_manager
+
+    db_managers = ManagerRegistry(
+        create_db_manager,
+        max_loaded=cfg.db_max_loaded,
+        max_bytes=cfg.db_memory_budget_mb * 2**20 if cfg.db_memory_budget_mb else None,
+        idle_seconds=cfg.db_idle_seconds,
+    )
+
+    def get_or_create_db_manager(dataset_id: str) -> DatabaseManager:
+        # a request leases the managers it uses, so they aren't evicted
+        # while it runs; the leases are released when the request tears down.
+        if not has_request_context():
+            return db_managers.get(dataset_id)
+        db_manager = db_managers.acquire(dataset_id)
+        g.setdefault('db_leases', []).append(dataset_id)
+        return db_manager
+
+    @app.teardown_request
+    def release_db_managers(error=None):
+        for dataset_id in g.pop('db_leases', ()):
+            db_managers.release(dataset_id)
+
+    if cfg.db_warm_datasets:
+        db_managers.warm([
+            dataset_id for dataset_id in cfg.db_warm_datasets
+            if dataset_manager.get_dataset(dataset_id)
+        ])
 
     @app.route('/')
     def index():
@@ -83,12 +215,23 @@ def make_app(cfg):
             filename = secure_filename(uniqueid)
             filepath = join(db_manager.config['UPLOAD_FOLDER'], filename)
             file.save(filepath)
+            db_manager.add_upload(filename)
             return jsonify({
                 'success': True,
                 'filename': filename,
                 'isQueryImage': True
             })
 
+    def resolve_query_image(db_manager: DatabaseManager, query_image: str):
+        upload_path = join(db_manager.config['UPLOAD_FOLDER'], query_image)
+        image_path = join(db_manager.config['IMAGE_FOLDER'], query_image)
+
+        if exists(upload_path):
+            return upload_path
+        elif exists(image_path):
+            return image_path
+        return None
+
     @app.route('/search', methods=['POST'])
     def search():
         data = request.get_json()
@@ -113,14 +256,8 @@ def make_app(cfg):
                 if not query_image:
                     return jsonify(dict(error='No query image provided.')), 400
 
-                upload_path = join(db_manager.config['UPLOAD_FOLDER'], query_image)
-                image_path = join(db_manager.config['IMAGE_FOLDER'], query_image)
-
-                if exists(upload_path):
-                    query_path = upload_path
-                elif exists(image_path):
-                    query_path = image_path
-                else:
+                query_path = resolve_query_image(db_manager, query_image)
+                if query_path is None:
                     return jsonify(dict(error='Query image not found.')), 404
 
                 results = db_manager.perform_search(
@@ -132,6 +269,127 @@ def make_app(cfg):
         except Exception as search_exception:
             return jsonify(dict(error=f'{search_exception=}')), 500
 
+    @app.route('/search/batch', methods=['POST'])
+    def batch_search():
+        data = request.get_json()
+        dataset_id = data.get('dataset_id')
+        if not dataset_id:
+            return jsonify(dict(error='Dataset ID is required.')), 400
+
+        try:
+            db_manager = get_or_create_db_manager(dataset_id)
+        except ValueError as db_manager_search_error:
+            return jsonify(dict(error=f'{db_manager_search_error=}')), 404
+
+        raw_queries = data.get('queries') or []
+        if not isinstance(raw_queries, list) or not raw_queries:
+            return jsonify(dict(error='A list of queries is required.')), 400
+
+        # plain strings are text prompts, dicts mirror the `/search` body.
+        try:
+            queries = []
+            for raw_query in raw_queries:
+                if isinstance(raw_query, str):
+                    raw_query = dict(type='text', query=raw_query)
+                if not isinstance(raw_query, dict):
+                    raise ValueError(f'{raw_query=} is neither a prompt nor a query object.')
+                query = dict(type=raw_query.get('type', 'text'))
+                if query['type'] == 'image':
+                    query['image'] = raw_query.get('image')
+                    query['query_path'] = resolve_query_image(db_manager, str(raw_query.get('image') or ''))
+                else:
+                    query['query'] = str(raw_query.get('query') or '').strip()
+                queries.append(query)
+
+            limit = int(data.get('limit', cfg.db_result_limit))
+            if limit < 1:
+                raise ValueError(f'{limit=} must be positive.')
+        except (TypeError, ValueError) as batch_query_error:
+            return jsonify(dict(error=f'{batch_query_error=}')), 400
+        limit = min(limit, cfg.db_result_limit)
+        stream = data.get('stream') or request.accept_mimetypes.best == 'application/x-ndjson'
+
+        try:
+            if stream:
+                def generate():
+                    for result in db_manager.iter_batch_search(queries, limit):
+                        result['query'].pop('query_path', None)
+                        yield json.dumps(result) + '\n'
+                return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+            results = db_manager.perform_batch_search(queries, limit)
+            for result in results:
+                result['query'].pop('query_path', None)
+            return jsonify(dict(results=results, total=len(results)))
+        except Exception as search_exception:
+            return jsonify(dict(error=f'{search_exception=}')), 500
+
+    @app.route('/search/federated', methods=['POST'])
+    def search_federated():
+        data = request.get_json()
+        dataset_ids = data.get('dataset_ids')
+        if dataset_ids:
+            if cfg.db_max_loaded and len(dataset_ids) > cfg.db_max_loaded:
+                return jsonify(dict(
+                    error=f'Can search at most {cfg.db_max_loaded} datasets at once.'
+                )), 400
+        else:
+            # without an explicit list, search what is loaded already and only
+            # load other datasets while that stays within the budget.
+            loaded = db_managers.loaded()
+            dataset_ids = loaded + [
+                dataset['id'] for dataset in dataset_manager.list_datasets()
+                if dataset['id'] not in loaded
+            ]
+            if cfg.db_max_loaded:
+                dataset_ids = dataset_ids[:max(cfg.db_max_loaded, len(loaded))]
+
+        try:
+            managers = [get_or_create_db_manager(dataset_id) for dataset_id in dataset_ids]
+        except ValueError as db_manager_search_error:
+            return jsonify(dict(error=f'{db_manager_search_error=}')), 404
+        if not managers:
+            return jsonify(dict(error='No datasets to search.')), 400
+
+        query_type = data.get('type')
+        limit = cfg.db_result_limit
+
+        try:
+            if query_type == 'text':
+                results = federated_search(
+                    managers,
+                    query_type,
+                    query=data.get('query', '').strip(),
+                    limit=limit,
+                    executor=search_executor,
+                )
+            elif query_type == 'image':
+                query_image = data.get('image')
+                if not query_image:
+                    return jsonify(dict(error='No query image provided.')), 400
+
+                # the query image belongs to one dataset, defaulting to the first.
+                source_manager = get_or_create_db_manager(data.get('image_dataset_id') or dataset_ids[0])
+                query_path = resolve_query_image(source_manager, query_image)
+                if query_path is None:
+                    return jsonify(dict(error='Query image not found.')), 404
+
+                results = federated_search(
+                    managers,
+                    query_type,
+                    query_path=query_path,
+                    source_manager=source_manager,
+                    limit=limit,
+                    executor=search_executor,
+                )
+            else:
+                return jsonify(dict(error='Invalid search type.')), 400
+            return jsonify(results)
+        except ValueError as search_value_error:
+            return jsonify(dict(error=f'{search_value_error=}')), 400
+        except Exception as search_exception:
+            return jsonify(dict(error=f'{search_exception=}')), 500
+
     @app.route('/get-all-images')
     def get_all_images():
         dataset_id = request.args.get('dataset_id')
@@ -143,53 +401,112 @@ def make_app(cfg):
         except ValueError as db_manager_images_error:
             return jsonify(dict(error=f'{db_manager_images_error=}')), 404
 
-        page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', cfg.images_per_page))
-        results = db_manager.collection.get()
-
-        unique_images = {}
-        for doc, metadata in zip(results['documents'], results['metadatas']):
-            filename = basename(doc)
-
-            file_path = join(db_manager.config['UPLOAD_FOLDER'], filename)
-            is_upload = exists(file_path)
-
-            url = f'/images/{filename}?dataset_id={dataset_id}'
-            if is_upload:
-                url = f'/uploads/{filename}?dataset_id={dataset_id}'
-
-            if filename not in unique_images:
-                unique_images[filename] = {
-                    'path': doc,
-                    'metadata': metadata,
-                    'filename': filename,
-                    'url': url,
-                    'prompt': metadata.get('prompt', f'{filename}'),
-                }
-
-        formatted_results = list(unique_images.values())
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        paginated_results = formatted_results[start_idx:end_idx]
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            rows = db_manager.manifest.list_files(after=int(cursor), limit=per_page + 1)
+        else:
+            # page numbers are still accepted, but cursors avoid the offset scan.
+            page = int(request.args.get('page', 1))
+            rows = db_manager.manifest.list_files(limit=per_page + 1, offset=(page - 1) * per_page)
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+
+        images = []
+        for row in rows:
+            filename = row['filename']
+            image = {
+                'path': row['path'],
+                'metadata': row['metadata'],
+                'filename': filename,
+                'url': f'/images/{filename}?dataset_id={dataset_id}',
+                'prompt': row['metadata'].get('prompt', f'{filename}'),
+            }
+            if db_manager.thumbnails is not None and row['digest']:
+                image['thumbnails'] = db_manager.thumbnails.urls(row['digest'], dataset_id)
+            images.append(image)
 
         return jsonify({
-            'images': paginated_results,
-            'total': len(formatted_results),
-            'has_more': end_idx < len(formatted_results),
-            'processing_status': db_manager.config['PROCESSING_STATUS']
+            'images': images,
+            'total': db_manager.manifest.get_count(),
+            'has_more': has_more,
+            'next_cursor': rows[-1]['seq'] if rows and has_more else None,
+            'processing_status': db_manager.get_status()
         })
 
+    def get_processing_status(dataset_id: str) -> Dict:
+        '''Latest status of a dataset, without loading its index.'''
+        if indexing:
+            status = status_events.get_latest(dataset_id)
+        else:
+            status = status_store.get(dataset_id)
+            if status is not None:
+                status.pop('generation')
+        return status or {'is_processing': False, 'processed_count': 0, 'total_count': 0}
+
+    def has_dataset(dataset_id: str) -> bool:
+        if not dataset_manager.get_dataset(dataset_id):
+            dataset_manager.refresh()
+        return dataset_manager.get_dataset(dataset_id) is not None
+
+    def poll_status_store():
+        '''Feed the indexing process's status of watched datasets to this worker's streams.'''
+        while True:
+            time.sleep(cfg.status_poll_interval)
+            for dataset_id in status_events.subscribed():
+                try:
+                    status_events.publish(dataset_id, get_processing_status(dataset_id))
+                except Exception as status_poll_error:
+                    app.logger.warning(f'{dataset_id}: {status_poll_error=}')
+
+    if not indexing:
+        # one reader per worker process, however many streams are open.
+        Thread(target=poll_status_store, daemon=True, name='status-poller').start()
+
     @app.route('/processing-status')
     def processing_status():
         dataset_id = request.args.get('dataset_id')
         if not dataset_id:
             return jsonify(dict(error='Dataset ID is required')), 400
+        if not has_dataset(dataset_id):
+            return jsonify(dict(error=f'{dataset_id=}')), 404
 
-        try:
-            db_manager = get_or_create_db_manager(dataset_id)
-            return jsonify(db_manager.config['PROCESSING_STATUS'])
-        except ValueError as db_manager_status_error:
-            return jsonify(dict(error=f'{db_manager_status_error=}')), 404
+        return jsonify(get_processing_status(dataset_id))
+
+    @app.route('/processing-status/stream')
+    def processing_status_stream():
+        '''Server-sent events with the processing status of a dataset, sent whenever it changes.'''
+        dataset_id = request.args.get('dataset_id')
+        if not dataset_id:
+            return jsonify(dict(error='Dataset ID is required')), 400
+        if not has_dataset(dataset_id):
+            return jsonify(dict(error=f'{dataset_id=}')), 404
+
+        def changes():
+            # the stream only stays open while the dataset is processing, so
+            # idle tabs don't hold a worker thread; `retry` spaces out the
+            # browser's reconnects until then.
+            subscription = status_events.subscribe(dataset_id)
+            try:
+                status = get_processing_status(dataset_id)
+                yield f'retry: {int(cfg.status_idle_retry * 1000)}\ndata: {json.dumps(status)}\n\n'
+                while status.get('is_processing'):
+                    event = subscription.get(timeout=cfg.status_heartbeat)
+                    if event is None:
+                        # comments keep proxies from closing a quiet stream.
+                        yield ': keep-alive\n\n'
+                        continue
+                    status = event
+                    yield f'data: {json.dumps(status)}\n\n'
+            finally:
+                subscription.close()
+
+        return Response(
+            stream_with_context(changes()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
 
     @app.route('/remove-temp', methods=['POST'])
     def remove_temp_files():
@@ -229,6 +546,25 @@ def make_app(cfg):
         except ValueError as serve_image_error:
             return jsonify(dict(error=f'{serve_image_error=}')), 404
 
+    @app.route('/thumbnails/<path:name>')
+    def serve_thumbnail(name):
+        dataset_id = request.args.get('dataset_id')
+        if not dataset_id:
+            return jsonify(dict(error='Dataset ID is required.')), 400
+
+        if not cfg.thumbnail_sizes:
+            return jsonify(dict(error='Thumbnails are disabled.')), 404
+        # thumbnails are plain files, so serving them never opens the index.
+        if not has_dataset(dataset_id):
+            return jsonify(dict(error='Dataset not found.')), 404
+
+        # names are content hashes, so a thumbnail never changes once written.
+        response = send_from_directory(
+            dataset_manager.get_dataset(dataset_id).thumbnail_folder, name, max_age=31536000
+        )
+        response.cache_control.immutable = True
+        return response
+
     @app.route('/static/<path:path>')
     def serve_static(path):
         return send_from_directory('static', path)
@@ -246,17 +582,97 @@ def make_app(cfg):
 
         dataset = dataset_manager.add_dataset(name)
         get_or_create_db_manager(dataset.id)
+        if not indexing:
+            status_store.request_sync(dataset.id)
         return jsonify(dict(id=dataset.id, name=dataset.name))
 
+    @app.route('/api/datasets/<dataset_id>/sync', methods=['POST'])
+    def sync_dataset(dataset_id):
+        try:
+            db_manager = get_or_create_db_manager(dataset_id)
+        except ValueError as db_manager_sync_error:
+            return jsonify(dict(error=f'{db_manager_sync_error=}')), 404
+
+        if indexing:
+            db_manager.start_initialization()
+        else:
+            status_store.request_sync(dataset_id)
+        return jsonify(dict(message='Dataset sync started.')), 202
+
     @app.route('/api/datasets/<dataset_id>', methods=['DELETE'])
     def delete_dataset(dataset_id):
         if dataset_manager.remove_dataset(dataset_id):
-            if dataset_id in db_managers:
-                del db_managers[dataset_id]
+            db_managers.remove(dataset_id)
+            status_store.remove(dataset_id)
+            status_events.forget(dataset_id)
+            manifests.pop(dataset_id, None)
             return jsonify(dict(message='Dataset removed successfully.'))
         return jsonify(dict(error='Dataset not found.')), 404
 
-    app = register_collection_routes(app, collection_manager)
+    manifests = {}
+
+    def describe_images(image_paths: List[str]) -> Dict[str, Dict]:
+        '''Urls, names and thumbnails for collection items, looked up in their datasets' catalogs.'''
+        descriptions, by_dataset = {}, {}
+        folders = [
+            (
+                dataset,
+                os.path.abspath(dataset.image_folder) + os.sep,
+                os.path.abspath(join(dataset.data_path, 'uploads')) + os.sep,
+            )
+            for dataset in dataset_manager.datasets.values()
+        ]
+        for image_path in image_paths:
+            absolute_path = os.path.abspath(image_path)
+            for dataset, image_folder, upload_folder in folders:
+                if absolute_path.startswith(upload_folder):
+                    filename = absolute_path[len(upload_folder):].replace(os.sep, '/')
+                    descriptions[image_path] = dict(
+                        dataset_id=dataset.id,
+                        filename=filename,
+                        url=f'/uploads/{filename}?dataset_id={dataset.id}',
+                    )
+                    break
+                if absolute_path.startswith(image_folder):
+                    by_dataset.setdefault(dataset.id, []).append((image_path, absolute_path[len(image_folder):]))
+                    break
+
+        for dataset_id, items in by_dataset.items():
+            dataset = dataset_manager.get_dataset(dataset_id)
+            files = {}
+            if exists(join(dataset.db_path, 'manifest.db')):
+                if dataset_id not in manifests:
+                    manifests[dataset_id] = ImageManifest(join(dataset.db_path, 'manifest.db'))
+                files = manifests[dataset_id].get_files([image_path for image_path, _ in items])
+
+            for image_path, relative_path in items:
+                entry = files.get(image_path)
+                filename = entry['filename'] if entry else relative_path.replace(os.sep, '/')
+                description = dict(
+                    dataset_id=dataset_id,
+                    filename=filename,
+                    url=f'/images/{filename}?dataset_id={dataset_id}',
+                    prompt=(entry['metadata'] if entry else {}).get('prompt', filename),
+                )
+                if entry and entry['digest'] and cfg.thumbnail_sizes:
+                    description['thumbnails'] = thumbnail_urls(entry['digest'], cfg.thumbnail_sizes, dataset_id)
+                descriptions[image_path] = description
+        return descriptions
+
+    export_executor = None
+    if cfg.export_workers:
+        export_executor = ThreadPoolExecutor(
+            max_workers=cfg.export_workers,
+            thread_name_prefix='export',
+        )
+
+    app = register_collection_routes(
+        app,
+        collection_manager,
+        export_executor,
+        describe_images,
+        cfg.images_per_page,
+    )
     return app
 
 @hydra.main(version_base=None, config_path='config', config_name='app')
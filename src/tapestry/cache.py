@@ -0,0 +1,229 @@
+from collections import OrderedDict
+import fcntl
+import hashlib
+import logging
+import numpy as np
+import os
+from os.path import exists, getsize, join
+import re
+from threading import Lock
+from typing import Any, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 16
+KEY_DTYPE = f'S{KEY_SIZE}'
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> bytes:
+    '''Content hash of the file bytes, used as the cache key.'''
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+class EmbeddingCache:
+    '''Content-addressed embedding store shared by every dataset.
+
+    Vectors are appended to a flat `vectors.<dtype>` file that is read back
+    through a memory map, and `keys.bin` holds the matching content hashes,
+    one fixed-size key per row, in insertion order. In memory the keys are
+    kept sorted in a numpy array next to their row numbers, about 24 bytes
+    per entry, and looked up by binary search.
+
+    Rows are numbered by position in the files, so only one process may
+    write. Others open the cache `read_only`: they never append or trim the
+    files, and read the rows the writer appended when a lookup misses.
+    A writer holds an exclusive lock on `writer.lock`. A second process that
+    asks to write while the lock is held falls back to reading.
+    '''
+    def __init__(
+        self,
+        cache_path: str,
+        model_id: str,
+        dimension: int,
+        dtype: str = 'float16',
+        read_only: bool = False,
+    ):
+        self.model_id = model_id
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.path = join(cache_path, re.sub(r'[^A-Za-z0-9._-]+', '_', model_id).strip('_'))
+        self.keys_path = join(self.path, 'keys.bin')
+        self.vectors_path = join(self.path, f'vectors.{self.dtype.name}')
+        self.row_bytes = self.dimension * self.dtype.itemsize
+        self.read_only = read_only
+        self.sorted_keys = np.empty(0, dtype=KEY_DTYPE)
+        self.sorted_rows = np.empty(0, dtype=np.int64)
+        self.rows = 0
+        self.vectors = None
+        self.lock = Lock()
+        self.writer_lock = None
+
+        if not self.read_only:
+            os.makedirs(self.path, exist_ok=True)
+            self.read_only = not self.lock_writer()
+        self.load()
+
+    def lock_writer(self) -> bool:
+        '''Take the single writer lock for this process, if no other holds it.'''
+        lock_file = open(join(self.path, 'writer.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logger.warning(f'embedding cache: {self.path} has another writer, opening it read-only')
+            return False
+        # the lock lasts as long as the file stays open.
+        self.writer_lock = lock_file
+        return True
+
+    def load(self) -> None:
+        keys = b''
+        if exists(self.keys_path):
+            with open(self.keys_path, 'rb') as keys_file:
+                keys = keys_file.read()
+        vector_rows = getsize(self.vectors_path) // self.row_bytes if exists(self.vectors_path) else 0
+
+        # the writer appends vectors before keys, so every complete key has
+        # its vector and only rows covered by both are used.
+        rows = min(len(keys) // KEY_SIZE, vector_rows)
+        if not self.read_only:
+            # drop any partially written tail so keys and vectors stay aligned.
+            with open(self.keys_path, 'ab') as keys_file:
+                keys_file.truncate(rows * KEY_SIZE)
+            with open(self.vectors_path, 'ab') as vectors_file:
+                vectors_file.truncate(rows * self.row_bytes)
+
+        key_array = np.frombuffer(keys, dtype=KEY_DTYPE, count=rows)
+        order = np.argsort(key_array, kind='stable')
+        self.sorted_keys = key_array[order]
+        self.sorted_rows = order.astype(np.int64)
+        self.rows = rows
+        self.vectors = None
+        logger.debug(f'embedding cache: {self.path}, {rows} vectors')
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _find(self, keys: List[bytes]) -> List[Optional[int]]:
+        '''Row of each key, or None for keys that aren't cached.'''
+        if not keys or not self.rows:
+            return [None] * len(keys)
+        queries = np.array(keys, dtype=KEY_DTYPE)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, queries), self.rows - 1)
+        found = self.sorted_keys[positions] == queries
+        return [
+            int(self.sorted_rows[position]) if hit else None
+            for position, hit in zip(positions, found)
+        ]
+
+    def _insert(self, keys: List[bytes], first_row: int) -> None:
+        '''Add `keys`, numbered from `first_row` on, to the sorted index.'''
+        key_array = np.array(keys, dtype=KEY_DTYPE)
+        order = np.argsort(key_array, kind='stable')
+        positions = np.searchsorted(self.sorted_keys, key_array[order])
+        self.sorted_keys = np.insert(self.sorted_keys, positions, key_array[order])
+        self.sorted_rows = np.insert(self.sorted_rows, positions, first_row + order)
+
+    def _matrix(self) -> Optional[np.memmap]:
+        if self.vectors is None and self.rows:
+            self.vectors = np.memmap(
+                self.vectors_path,
+                dtype=self.dtype,
+                mode='r',
+                shape=(self.rows, self.dimension),
+            )
+        return self.vectors
+
+    def _grown(self) -> bool:
+        return exists(self.keys_path) and getsize(self.keys_path) // KEY_SIZE > self.rows
+
+    def load_tail(self) -> None:
+        '''Index the rows appended by the writer since the last load.'''
+        vector_rows = getsize(self.vectors_path) // self.row_bytes if exists(self.vectors_path) else 0
+        with open(self.keys_path, 'rb') as keys_file:
+            keys_file.seek(self.rows * KEY_SIZE)
+            keys = keys_file.read(max(0, vector_rows - self.rows) * KEY_SIZE)
+        appended = len(keys) // KEY_SIZE
+        if not appended:
+            return
+        self._insert(np.frombuffer(keys, dtype=KEY_DTYPE, count=appended), self.rows)
+        self.rows += appended
+        self.vectors = None
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        with self.lock:
+            rows = self._find(keys)
+            if self.read_only and None in rows and self._grown():
+                self.load_tail()
+                rows = self._find(keys)
+            matrix = self._matrix()
+        return [
+            None if row is None else np.asarray(matrix[row], dtype=np.float32)
+            for row in rows
+        ]
+
+    def put_many(self, keys: List[bytes], vectors: List[np.ndarray]) -> None:
+        if self.read_only:
+            return
+        with self.lock:
+            new_keys, new_vectors = [], []
+            seen = set()
+            for key, vector, row in zip(keys, vectors, self._find(keys)):
+                if row is not None or key in seen:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_vectors.append(np.asarray(vector, dtype=self.dtype).reshape(self.dimension))
+
+            if not new_keys:
+                return
+
+            # vectors are written first, so a crash leaves at most orphaned
+            # vector rows, which `load` trims away.
+            with open(self.vectors_path, 'ab') as vectors_file:
+                vectors_file.write(np.stack(new_vectors).tobytes())
+            with open(self.keys_path, 'ab') as keys_file:
+                keys_file.write(b''.join(new_keys))
+
+            self._insert(new_keys, self.rows)
+            self.rows += len(new_keys)
+            self.vectors = None
+
+class LRUCache:
+    '''Bounded, thread-safe mapping that evicts the least recently used key.
+
+    Cached values are shared between callers and must not be mutated.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
@@ -1,20 +1,145 @@
-from flask import jsonify, request, send_file
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from flask import Response, jsonify, request, stream_with_context
 import io
+from itertools import islice
 import json
 import os
 import sqlite3
-from typing import Dict, List, Optional
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import uuid
 import zipfile
 
+# items are spaced this far apart, so a move can usually take a free slot
+# between its new neighbours without renumbering anything else.
+POSITION_GAP = 1024
+
+STORED_EXTENSIONS = {'.gif', '.jpg', '.jpeg', '.png', '.webp'}
+
+class ZipStream(io.RawIOBase):
+    '''Write-only, unseekable sink that hands written bytes back on `drain`.'''
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def zip_info(image_path: str, size: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo.from_file(image_path, os.path.basename(image_path))
+    info.file_size = size
+    extension = os.path.splitext(image_path)[1].lower()
+    # re-compressing jpeg, png and webp costs cpu for next to no gain.
+    info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+    return info
+
+def read_file(image_path: str) -> Optional[bytes]:
+    try:
+        with open(image_path, 'rb') as image_file:
+            return image_file.read()
+    except OSError:
+        return None
+
+def iter_zip(
+    metadata: Dict,
+    image_paths: List[str],
+    executor: Executor = None,
+    read_ahead: int = 8,
+    chunk_size: int = 1 << 20,
+) -> Iterator[bytes]:
+    '''Yield a zip archive of `metadata.json` followed by `image_paths`.
+
+    Memory stays bounded by the chunk size, or by `read_ahead` whole files
+    when reads are spread over an executor.
+    '''
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('metadata.json', json.dumps(metadata, indent=2))
+        yield stream.drain()
+
+        image_paths = [path for path in image_paths if os.path.isfile(path)]
+        if executor is None:
+            for image_path in image_paths:
+                try:
+                    info = zip_info(image_path, os.path.getsize(image_path))
+                    with open(image_path, 'rb') as src, zf.open(info, 'w') as dest:
+                        while chunk := src.read(chunk_size):
+                            dest.write(chunk)
+                            yield stream.drain()
+                except OSError:
+                    continue
+                yield stream.drain()
+        else:
+            pending = deque()
+            paths = iter(image_paths)
+            for image_path in islice(paths, read_ahead):
+                pending.append((image_path, executor.submit(read_file, image_path)))
+            while pending:
+                image_path, future = pending.popleft()
+                for next_path in islice(paths, 1):
+                    pending.append((next_path, executor.submit(read_file, next_path)))
+                data = future.result()
+                if data is None:
+                    continue
+                zf.writestr(zip_info(image_path, len(data)), data)
+                yield stream.drain()
+
+    yield stream.drain()
+
+def iter_zip_chunks(*args, **kwargs) -> Iterator[bytes]:
+    return (chunk for chunk in iter_zip(*args, **kwargs) if chunk)
+
 class CollectionManager:
-    def __init__(self, db_path: str):
+    '''Collections and their ordered items, stored in SQLite.
+
+    Each thread keeps one open connection in WAL mode, so readers never
+    block the writer, and writes run in short `BEGIN IMMEDIATE`
+    transactions that wait out each other via `busy_timeout` instead of
+    failing with `database is locked`.
+    '''
+    def __init__(self, db_path: str, busy_timeout: int = 5000):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
         self.init_db()
 
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout / 1000)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        '''Write transaction that takes the write lock up front, committed on exit.'''
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS collections (
                     id TEXT PRIMARY KEY,
@@ -32,73 +157,79 @@ class CollectionManager:
                     PRIMARY KEY (collection_id, image_path)
                 )
             ''')
-            conn.commit()
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS collection_items_position
+                ON collection_items (collection_id, position)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS collections_created_at
+                ON collections (created_at)
+            ''')
+            # foreign keys used to be off, so deleted collections left their items behind.
+            cursor.execute('''
+                DELETE FROM collection_items
+                WHERE collection_id NOT IN (SELECT id FROM collections)
+            ''')
+            # moves could store a null position, which drops items out of paging.
+            cursor.execute('SELECT DISTINCT collection_id FROM collection_items WHERE position IS NULL')
+            for (collection_id,) in cursor.fetchall():
+                self.rebalance(cursor, collection_id)
 
     def create_collection(self, name: str) -> Dict:
         collection_id = str(uuid.uuid4())
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute(
                 'INSERT INTO collections (id, name) VALUES (?, ?)',
                 (collection_id, name)
             )
-            conn.commit()
         return dict(id=collection_id, name=name)
 
     def get_collections(self) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, name FROM collections ORDER BY created_at DESC')
-            return [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT id, name FROM collections ORDER BY created_at DESC')
+        return [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
 
     def update_collection(self, collection_id: str, name: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute(
                 'UPDATE collections SET name = ? WHERE id = ?',
                 (name, collection_id)
             )
-            conn.commit()
             return cursor.rowcount > 0
 
     def delete_collection(self, collection_id: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute('DELETE FROM collections WHERE id = ?', (collection_id,))
-            conn.commit()
             return cursor.rowcount > 0
 
-    def export_collection(self, collection_id: str) -> io.BytesIO:
-        memory_file = io.BytesIO()
-
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT name FROM collections WHERE id = ?', (collection_id,))
-            collection_name = cursor.fetchone()[0]
-
-            cursor.execute('''
-                SELECT image_path, position
-                FROM collection_items
-                WHERE collection_id = ?
-                ORDER BY position
-            ''', (collection_id,))
-
-            images = [{'path': row[0], 'position': row[1]} for row in cursor.fetchall()]
-
-            with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-                image_data = [
-                    dict(filename=os.path.basename(img['path']), index=i) \
-                        for i,img in enumerate(images)
-                ]
-                metadata = dict(id=collection_id, name=collection_name, images=image_data)
-                zf.writestr('metadata.json', json.dumps(metadata, indent=2))
-                for img in images:
-                    image_path = img['path']
-                    if os.path.isfile(image_path):
-                        zf.write(image_path, os.path.basename(image_path))
-
-        memory_file.seek(0)
-        return memory_file
+    def export_collection(
+        self,
+        collection_id: str,
+        executor: Executor = None,
+        read_ahead: int = 8,
+        chunk_size: int = 1 << 20,
+    ) -> Iterator[bytes]:
+        '''Stream the collection as a zip archive, chunk by chunk.
+
+        Raises `KeyError` for an unknown collection before anything is
+        streamed. Already compressed images are stored as is, and with an
+        `executor` up to `read_ahead` files are read in parallel.
+        '''
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT name FROM collections WHERE id = ?', (collection_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(collection_id)
+        collection_name = row[0]
+        images = self.get_collection_images(collection_id)
+
+        image_data = [
+            dict(filename=os.path.basename(img['path']), index=i) \
+                for i,img in enumerate(images)
+        ]
+        metadata = dict(id=collection_id, name=collection_name, images=image_data)
+        image_paths = [img['path'] for img in images]
+        return iter_zip_chunks(metadata, image_paths, executor, read_ahead, chunk_size)
 
     def add_images_to_collection(
         self,
@@ -106,60 +237,185 @@ class CollectionManager:
         image_paths: List[str],
         positions: Optional[List[int]] = None
     ) -> bool:
-        if positions is None:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+        # one transaction, so concurrent appends can't claim the same positions.
+        with self.transaction() as cursor:
+            if positions is None:
                 cursor.execute(
                     'SELECT COALESCE(MAX(position), -1) FROM collection_items WHERE collection_id = ?',
                     (collection_id,)
                 )
                 max_position = cursor.fetchone()[0]
-                positions = list(range(max_position + 1, max_position + 1 + len(image_paths)))
+                start = max_position + POSITION_GAP if max_position >= 0 else 0
+                positions = list(range(start, start + POSITION_GAP * len(image_paths), POSITION_GAP))
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
             cursor.executemany(
                 'INSERT OR REPLACE INTO collection_items (collection_id, image_path, position) VALUES (?, ?, ?)',
                 [(collection_id, path, pos) for path, pos in zip(image_paths, positions)]
             )
-            conn.commit()
             return True
 
     def remove_images_from_collection(self, collection_id: str, image_paths: List[str]) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.executemany(
                 'DELETE FROM collection_items WHERE collection_id = ? AND image_path = ?',
                 [(collection_id, path) for path in image_paths]
             )
-            conn.commit()
             return cursor.rowcount > 0
 
-    def get_collection_images(self, collection_id: str) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                '''
-                SELECT image_path, position
-                FROM collection_items
-                WHERE collection_id = ?
-                ORDER BY position
-                ''',
-                (collection_id,)
-            )
-            return [{'path': row[0], 'position': row[1]} for row in cursor.fetchall()]
+    def get_collection_images(
+        self,
+        collection_id: str,
+        after: Optional[Tuple[int, str]] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict]:
+        '''Items in order, optionally the `limit` ones after the (position, path) cursor `after`.'''
+        query = '''
+            SELECT image_path, position
+            FROM collection_items
+            WHERE collection_id = ?
+        '''
+        params = [collection_id]
+        if after is not None:
+            query += ' AND (position > ? OR (position = ? AND image_path > ?))'
+            params += [after[0], after[0], after[1]]
+        query += ' ORDER BY position, image_path'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        cursor = self.connection().cursor()
+        cursor.execute(query, params)
+        return [{'path': row[0], 'position': row[1]} for row in cursor.fetchall()]
+
+    def count_collection_images(self, collection_id: str) -> int:
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM collection_items WHERE collection_id = ?', (collection_id,))
+        return cursor.fetchone()[0]
 
     def update_image_positions(self, collection_id: str, position_updates: List[Dict[str, int]]) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.executemany(
                 'UPDATE collection_items SET position = ? WHERE collection_id = ? AND image_path = ?',
                 [(update['position'], collection_id, update['path']) for update in position_updates]
             )
-            conn.commit()
             return cursor.rowcount > 0
 
-def register_collection_routes(app, collections_manager):
+    def get_position(self, cursor: sqlite3.Cursor, collection_id: str, image_path: str) -> int:
+        cursor.execute(
+            'SELECT position FROM collection_items WHERE collection_id = ? AND image_path = ?',
+            (collection_id, image_path)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(image_path)
+        return row[0]
+
+    def neighbour_position(
+        self,
+        cursor: sqlite3.Cursor,
+        collection_id: str,
+        image_path: str,
+        position: int,
+        before: bool,
+    ) -> Optional[int]:
+        '''Position of the closest item before (or after) `position`, ignoring `image_path`.'''
+        cursor.execute(
+            f'''
+            SELECT {'MAX' if before else 'MIN'}(position)
+            FROM collection_items
+            WHERE collection_id = ? AND image_path != ? AND position {'<' if before else '>'} ?
+            ''',
+            (collection_id, image_path, position)
+        )
+        return cursor.fetchone()[0]
+
+    def position_between(
+        self,
+        cursor: sqlite3.Cursor,
+        collection_id: str,
+        image_path: str,
+        after: Optional[str],
+        before: Optional[str],
+    ) -> Optional[int]:
+        '''A free position between `after` and `before`, or None if they are adjacent.
+
+        Raises ValueError if `after` doesn't come before `before`.
+        '''
+        low = self.get_position(cursor, collection_id, after) if after else None
+        high = self.get_position(cursor, collection_id, before) if before else None
+        if low is not None and high is not None and low >= high:
+            raise ValueError(f'{after=} does not come before {before=}')
+
+        if low is None and high is None:
+            cursor.execute(
+                'SELECT MAX(position) FROM collection_items WHERE collection_id = ? AND image_path != ?',
+                (collection_id, image_path)
+            )
+            low = cursor.fetchone()[0]
+            return 0 if low is None else low + POSITION_GAP
+        if low is None:
+            low = self.neighbour_position(cursor, collection_id, image_path, high, before=True)
+        elif high is None:
+            high = self.neighbour_position(cursor, collection_id, image_path, low, before=False)
+
+        if low is None:
+            return high - POSITION_GAP
+        if high is None:
+            return low + POSITION_GAP
+        if high - low > 1:
+            return (low + high) // 2
+        return None
+
+    def rebalance(self, cursor: sqlite3.Cursor, collection_id: str) -> None:
+        '''Respace every item of the collection `POSITION_GAP` apart, keeping their order.'''
+        cursor.execute(
+            'SELECT image_path FROM collection_items WHERE collection_id = ? ORDER BY position IS NULL, position, rowid',
+            (collection_id,)
+        )
+        cursor.executemany(
+            'UPDATE collection_items SET position = ? WHERE collection_id = ? AND image_path = ?',
+            [(idx * POSITION_GAP, collection_id, row[0]) for idx, row in enumerate(cursor.fetchall())]
+        )
+
+    def move_image(
+        self,
+        collection_id: str,
+        image_path: str,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+    ) -> bool:
+        '''Move `image_path` between `after` and `before`, updating only its own row.
+
+        Either neighbour may be omitted to move next to the other one, and
+        without both the image moves to the end. Only when the neighbours
+        have no free position left is the whole collection respaced.
+
+        Raises ValueError for neighbours that are the image itself or out of
+        order, as sent by a client with a stale view of the collection.
+        '''
+        if image_path in (after, before):
+            raise ValueError(f'{image_path=} cannot be its own neighbour')
+        with self.transaction() as cursor:
+            position = self.position_between(cursor, collection_id, image_path, after, before)
+            if position is None:
+                self.rebalance(cursor, collection_id)
+                position = self.position_between(cursor, collection_id, image_path, after, before)
+            if position is None:
+                raise ValueError(f'no position between {after=} and {before=}')
+
+            cursor.execute(
+                'UPDATE collection_items SET position = ? WHERE collection_id = ? AND image_path = ?',
+                (position, collection_id, image_path)
+            )
+            return cursor.rowcount > 0
+
+def register_collection_routes(
+    app,
+    collections_manager,
+    export_executor: Executor = None,
+    describe_images: Callable[[List[str]], Dict[str, Dict]] = None,
+    page_size: int = 100,
+):
     @app.route('/collections', methods=['GET'])
     def get_collections():
         try:
@@ -183,8 +439,32 @@ def register_collection_routes(app, collections_manager):
     @app.route('/collections/<collection_id>', methods=['GET'])
     def get_collection(collection_id):
         try:
-            images = collections_manager.get_collection_images(collection_id)
-            return jsonify(dict(images=images))
+            per_page = int(request.args.get('per_page', page_size))
+            cursor = request.args.get('cursor')
+            after = None
+            if cursor:
+                # cursors are `<position>:<path>`, so ties on position stay ordered.
+                position, path = cursor.split(':', 1)
+                after = (int(position), path)
+
+            images = collections_manager.get_collection_images(collection_id, after, per_page + 1)
+            has_more = len(images) > per_page
+            images = images[:per_page]
+
+            if describe_images is not None:
+                descriptions = describe_images([image['path'] for image in images])
+                for image in images:
+                    image.update(descriptions.get(image['path'], {}))
+
+            last = images[-1] if images else None
+            return jsonify(dict(
+                images=images,
+                total=collections_manager.count_collection_images(collection_id),
+                has_more=has_more,
+                next_cursor=f"{last['position']}:{last['path']}" if last and has_more else None,
+            ))
+        except ValueError as get_collection_error:
+            return jsonify(dict(error=f'{get_collection_error=}')), 400
         except Exception as get_collection_exception:
             return jsonify(dict(error=get_collection_exception)), 500
 
@@ -271,17 +551,41 @@ def register_collection_routes(app, collections_manager):
         except Exception as update_position_exception:
             return jsonify(dict(error=update_position_exception)), 500
 
+    @app.route('/collections/<collection_id>/move', methods=['PATCH'])
+    def move_image(collection_id):
+        try:
+            data = request.get_json()
+            image_path = data.get('path')
+            if not image_path:
+                return jsonify(dict(error='Image path is required.')), 400
+
+            success = collections_manager.move_image(
+                collection_id, image_path, data.get('after'), data.get('before')
+            )
+
+            if success:
+                return jsonify(dict(message='Image moved successfully!'))
+            return jsonify(dict(error='Image not found.')), 404
+        except KeyError as move_image_error:
+            return jsonify(dict(error=f'Image not found: {move_image_error}')), 404
+        except ValueError as move_image_error:
+            return jsonify(dict(error=f'{move_image_error}')), 400
+        except Exception as move_image_exception:
+            return jsonify(dict(error=f'{move_image_exception=}')), 500
+
     @app.route('/collections/<collection_id>/export', methods=['GET'])
     def export_collection(collection_id):
         try:
-            memory_file = collections_manager.export_collection(collection_id)
-            return send_file(
-                memory_file,
-                mimetype='application/zip',
-                as_attachment=True,
-                download_name=f'{collection_id}-collection.zip'
-            )
+            chunks = collections_manager.export_collection(collection_id, export_executor)
+        except KeyError:
+            return jsonify(dict(error='Collection not found.')), 404
         except Exception as export_collection_error:
-            return jsonify(dict(error=export_collection_error)), 500
+            return jsonify(dict(error=f'{export_collection_error=}')), 500
+
+        return Response(
+            stream_with_context(chunks),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={collection_id}-collection.zip'},
+        )
 
     return app
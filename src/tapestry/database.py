@@ -1,19 +1,175 @@
 import chromadb
-from glob import glob
+from chromadb.api.shared_system_client import SharedSystemClient
+from concurrent.futures import Executor
+from contextlib import closing
+import fcntl
+import heapq
+from itertools import count, islice
 import logging
+import numpy as np
 from omegaconf import OmegaConf
 import os
 from os.path import basename, exists, join
-import random
-from threading import Thread
+from queue import Queue
+import shutil
+import sqlite3
+from threading import Event, Lock, Thread, Timer
+import time
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
+from tapestry.cache import EmbeddingCache, LRUCache
 from tapestry.embeddings import Embedder
+from tapestry.events import StatusBroker
+from tapestry.manifest import ImageManifest
+from tapestry.status import StatusStore
+from tapestry.thumbnails import ThumbnailCache
+from tapestry.vectorstore import NumpyCollection, ShardedCollection, shard_of
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+# generations are unique across managers, so a recreated dataset never
+# collides with results cached for its predecessor.
+generations = count(1)
+
+# scanned files compared with the manifest per lookup.
+SCAN_CHUNK = 500
+
+# ioctl that shares a file's extents copy-on-write, on btrfs and xfs.
+FICLONE = 0x40049409
+
+# recent batch errors kept in the processing status.
+MAX_STATUS_ERRORS = 20
+
+# published index snapshots kept for serving processes, see `write_snapshot`.
+SNAPSHOTS_KEPT = 2
+
+def iter_image_files(root: str, image_extensions: List[str], errors: List[OSError] = None):
+    '''Recursively yield (path, size, mtime) for images under `root`.
+
+    Unreadable directories and entries are skipped, and their errors are
+    appended to `errors`, since files below them are missing from the walk.
+    '''
+    extensions = {ext.lower() for ext in image_extensions}
+    pending = [root]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as scanner:
+                for entry in scanner:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in extensions:
+                            stat = entry.stat()
+                            yield entry.path, stat.st_size, stat.st_mtime
+                    except OSError as scan_entry_error:
+                        logger.warning(f'{scan_entry_error=}')
+                        if errors is not None:
+                            errors.append(scan_entry_error)
+        except OSError as scan_error:
+            logger.warning(f'{scan_error=}')
+            if errors is not None:
+                errors.append(scan_error)
+
+def clone_file(source: str, target: str) -> None:
+    '''Copy a file, as a reflink where the filesystem supports it.'''
+    try:
+        with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        shutil.copystat(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def copy_store(source: str, target: str, skip: tuple = (), link: bool = False) -> None:
+    '''Copy an index directory, reading sqlite databases through the backup api.
+
+    With `link` the source must no longer change, as for a published
+    snapshot: sqlite databases are cloned as files and everything else,
+    such as hnsw index files that readers never write, is hard-linked.
+    '''
+    os.makedirs(target)
+    for entry in os.scandir(source):
+        if entry.name in skip or entry.name.endswith(('-wal', '-shm', '-journal')):
+            continue
+        path = join(target, entry.name)
+        if entry.is_dir():
+            copy_store(entry.path, path, link=link)
+        elif entry.name.endswith(('.sqlite3', '.db')):
+            if link:
+                clone_file(entry.path, path)
+                continue
+            with closing(sqlite3.connect(entry.path)) as source_db, closing(sqlite3.connect(path)) as target_db:
+                source_db.backup(target_db)
+        elif link:
+            try:
+                os.link(entry.path, path)
+            except OSError:
+                clone_file(entry.path, path)
+        else:
+            # the writer rewrites these files in place, so they can't be linked.
+            clone_file(entry.path, path)
+
+def close_collection(collection) -> None:
+    '''Stop the threads a sharded collection started for its fan-out.'''
+    if isinstance(collection, ShardedCollection):
+        collection.close()
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def federated_search(
+    db_managers: List['DatabaseManager'],
+    query_type: str,
+    query: str = None,
+    query_path: str = None,
+    source_manager: 'DatabaseManager' = None,
+    limit: int = None,
+    executor: Executor = None,
+) -> Dict:
+    '''Embed a query once, search every manager in parallel and merge by distance.
+
+    Image queries are embedded by `source_manager`, the dataset the query
+    image belongs to, so an indexed image reuses its stored vector.
+    '''
+    source_manager = source_manager or db_managers[0]
+    embedding = source_manager.embed_query(query_type, query, query_path)
+    if embedding is None:
+        raise ValueError('Failed to embed query.')
+
+    def search(db_manager):
+        try:
+            results = db_manager.search_by_embedding(embedding, query_type, query_path, limit)['results']
+        except Exception as federated_search_error:
+            logger.error(f'{db_manager.dataset_id}: {federated_search_error=}', exc_info=True)
+            return []
+        for result in results:
+            result['dataset_id'] = db_manager.dataset_id
+        return results
+
+    if executor is not None:
+        per_dataset = list(executor.map(search, db_managers))
+    else:
+        per_dataset = [search(db_manager) for db_manager in db_managers]
+
+    # each dataset's results are already sorted, so a k-way merge suffices.
+    merged = list(islice(heapq.merge(*per_dataset, key=lambda result: result['distance']), limit))
+    for idx, result in enumerate(merged):
+        result['rank'] = idx + 1
+
+    return dict(
+        results=merged,
+        total=len(merged),
+        query_type=query_type,
+        dataset_ids=[db_manager.dataset_id for db_manager in db_managers],
+    )
+
 class DatabaseManager:
     def __init__(
         self,
@@ -26,6 +182,27 @@ class DatabaseManager:
         embedding_image_size: int = (1024, 1024),
         image_extensions: list = ['.gif', '.jpg', '.jpeg', '.png', '.webp'],
         batch_size: int = 32,
+        max_in_flight: int = 4,
+        timeout: int = 10,
+        transport: str = 'base64',
+        embedding_cache: EmbeddingCache = None,
+        preprocess_workers: int = 0,
+        thumbnails: ThumbnailCache = None,
+        backend: str = 'chroma',
+        vector_dtype: str = 'float32',
+        quantization: str = None,
+        rerank_factor: int = 4,
+        shards: int = 1,
+        auto_initialize: bool = True,
+        text_cache: LRUCache = None,
+        result_cache: LRUCache = None,
+        status_store: StatusStore = None,
+        indexing: bool = True,
+        reload_interval: float = 30,
+        status_events: StatusBroker = None,
+        snapshots: bool = False,
+        max_request_bytes: int = None,
+        shard: int = None,
     ):
         self.config = app_config
         self.db_path = db_path
@@ -33,10 +210,49 @@ class DatabaseManager:
         self.db_meta = OmegaConf.to_container(db_meta, resolve=True)
         self.image_extensions = image_extensions
         self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.transport = transport
+        self.embedding_cache = embedding_cache
+        self.preprocess_workers = preprocess_workers
+        self.thumbnails = thumbnails
+        self.backend = backend
+        self.vector_dtype = vector_dtype
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.shards = shards
+        # a shard build opens and syncs only its own shard of the collection.
+        self.shard = shard
+        self.result_cache = result_cache
+        self.uploads = None
+        # bumped whenever search results may change, which retires cached results.
+        self.generation = next(generations)
+        # without `indexing`, another process owns the index and this manager
+        # only serves it, reloading when the shared generation moves on.
+        self.status_store = status_store
+        self.indexing = indexing
+        self.reload_interval = reload_interval
+        self.status_events = status_events
+        self.sync_started = None
+        # an indexer with `snapshots` publishes a copy of the collection after
+        # every sync that changed it, and serving managers open the latest
+        # copy instead of the directory being written to.
+        self.snapshots = snapshots
+        self.snapshot_root = join(self.db_path, 'snapshots')
+        self.snapshot_token = None
+        self.store_path = self.db_path
+        self.collection_changed = False
+        self.checked_at = time.monotonic()
+        self.shared_generation = None
         self.embedding_model_address = embedding_model_address
         self.embedding_dimension = embedding_dimension
         self.embedding_image_size = embedding_image_size
         self.initialization_complete = False
+        self.index_lock = Lock()
+        # held while a serving manager reloads a snapshot in the background.
+        self.refresh_lock = Lock()
+        self.status_lock = Lock()
+        self.stop_event = Event()
 
         logger.debug(f'manager: {db_path}, name: {db_name}, {self.config["IMAGE_FOLDER"]}')
 
@@ -44,22 +260,41 @@ class DatabaseManager:
         os.makedirs(self.config['UPLOAD_FOLDER'], exist_ok=True)
         os.makedirs(self.db_path, exist_ok=True)
 
+        self.manifest = ImageManifest(join(self.db_path, 'manifest.db'))
+
         self.embedder = Embedder(
             self.embedding_model_address,
             self.embedding_dimension,
             self.embedding_image_size,
+            timeout=self.timeout,
+            batch_size=self.batch_size,
+            max_in_flight=self.max_in_flight,
+            transport=self.transport,
+            cache=self.embedding_cache,
+            preprocess_workers=self.preprocess_workers,
+            text_cache=text_cache,
+            max_request_bytes=max_request_bytes,
         )
 
         try:
-            self.chroma_client = chromadb.PersistentClient(path=self.db_path)
-            self.collection = self.chroma_client.get_or_create_collection(
-                name=self.db_name,
-                metadata=self.db_meta,
-                embedding_function=self.embedder,
-            )
-            logger.debug(f'get {self.db_name}')
+            if not self.indexing:
+                self.snapshot_token = self.latest_snapshot()
+                self.store_path = self.checkout_snapshot(self.snapshot_token)
+            self.chroma_clients = []
+            self.collection = self.open_collections()
+            self.chroma_client = self.chroma_clients[0] if self.chroma_clients else None
+            logger.debug(f'get {self.db_name} ({self.backend})')
+            # the manifest is shared by every backend and shard count, so a
+            # dataset moved to another layout starts over with an empty one.
+            if self.indexing and self.manifest.use_layout(
+                f'{self.backend}/{self.shards}',
+                empty=self.shard is None and self.collection.count() == 0,
+            ):
+                logger.info(f'{self.db_name}: collection layout changed, reindexing.')
+            if self.status_store is not None and not self.indexing:
+                self.shared_generation = (self.status_store.get(self.dataset_id) or {}).get('generation')
 
-            if len(self.collection.get()['ids']) == 0:
+            if auto_initialize and self.indexing and self.collection.count() == 0:
                 logger.debug('empty collection, starting initialization...')
                 self.start_initialization()
 
@@ -67,102 +302,540 @@ class DatabaseManager:
             logger.error(f'{db_manager_init_error=}', exc_info=True)
             raise
 
+    def open_collections(self):
+        if self.shards > 1 and self.shard is not None:
+            return self.open_collection(f'shard-{self.shard}')
+        if self.shards > 1:
+            return ShardedCollection(
+                [self.open_collection(f'shard-{shard}') for shard in range(self.shards)],
+                embedding_function=self.embedder,
+            )
+        return self.open_collection()
+
+    def open_collection(self, shard_name: str = None):
+        '''Open the collection, or one shard of it, for the configured backend.'''
+        if self.backend == 'numpy':
+            path = join(self.store_path, f'{self.db_name}.numpy')
+            return NumpyCollection(
+                f'{path}.{shard_name}' if shard_name else path,
+                self.db_name,
+                self.embedding_dimension,
+                metadata=self.db_meta,
+                embedding_function=self.embedder,
+                dtype=self.vector_dtype,
+                quantization=self.quantization,
+                rerank_factor=self.rerank_factor,
+            )
+        if self.backend == 'chroma':
+            # every shard gets its own directory, so shards never share an index.
+            client = chromadb.PersistentClient(
+                path=join(self.store_path, shard_name) if shard_name else self.store_path
+            )
+            self.chroma_clients.append(client)
+            return client.get_or_create_collection(
+                name=self.db_name,
+                metadata=self.db_meta,
+                embedding_function=self.embedder,
+            )
+        raise ValueError(f'{self.backend=}')
+
+    def file_id(self, filename: str) -> str:
+        '''Stable id for an image, so its shard is known before it is embedded.'''
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{self.db_name}/{filename}'))
+
+    def owns(self, file_id: str, shard: int = None) -> bool:
+        return shard is None or shard_of(file_id, self.shards) == shard
+
+    @property
+    def dataset_id(self) -> str:
+        suffix = '_images'
+        if self.db_name.endswith(suffix):
+            return self.db_name[:-len(suffix)]
+        return self.db_name.split('_')[0]
+
     def start_initialization(self) -> None:
         thread = Thread(target=self.initialize_database)
         thread.daemon = False
         thread.start()
         return thread
 
-    def initialize_database(self) -> None:
-        logger.debug('Starting database initialization')
-        self.config['PROCESSING_STATUS']['is_processing'] = True
+    def start_watcher(self, interval: float) -> Thread:
+        '''Re-sync the image folder every `interval` seconds until `close`.'''
+        def watch():
+            while not self.stop_event.wait(interval):
+                self.initialize_database()
+
+        thread = Thread(target=watch, daemon=True)
+        thread.start()
+        return thread
+
+    def release_chroma_systems(self, clients: List) -> List:
+        '''Drop the cached chroma systems behind `clients` and return them.'''
+        # clients on one directory share a cached system, which is what keeps
+        # the hnsw index in memory, so a new client only reloads once it's gone.
+        systems = [SharedSystemClient._identifier_to_system.pop(client._identifier, None) for client in clients]
+        return [system for system in systems if system is not None]
+
+    def latest_snapshot(self) -> Optional[str]:
+        try:
+            names = os.listdir(self.snapshot_root)
+        except FileNotFoundError:
+            return None
+        return max((name for name in names if name.isdigit()), key=int, default=None)
+
+    def write_snapshot(self) -> None:
+        '''Publish a copy of the collection for serving processes to open.
+
+        Called at the end of a sync, while no batch is being written. The copy
+        is staged under a temporary name and renamed, so readers never see a
+        partial snapshot.
+        '''
+        token = str(time.time_ns())
+        staging = join(self.snapshot_root, f'{token}.tmp')
+        os.makedirs(self.snapshot_root, exist_ok=True)
+        copy_store(self.db_path, staging, skip=('manifest.db', 'snapshots'))
+        os.rename(staging, join(self.snapshot_root, token))
+        logger.debug(f'snapshot {self.db_name}: {token}')
+        self.prune_snapshots()
+
+    def prune_snapshots(self) -> None:
+        '''Delete older snapshots, failed stagings and copies of exited serving processes.'''
+        names = os.listdir(self.snapshot_root)
+        published = sorted((name for name in names if name.isdigit()), key=int)
+        stale = published[:-SNAPSHOTS_KEPT]
+        for name in names:
+            if name.endswith('.tmp'):
+                stale.append(name)
+            elif '.reader-' in name and not pid_alive(int(name.rsplit('-', 1)[1])):
+                stale.append(name)
+        for name in stale:
+            shutil.rmtree(join(self.snapshot_root, name), ignore_errors=True)
+
+    def checkout_snapshot(self, token: Optional[str]) -> str:
+        '''Directory to open the collection from for snapshot `token`.'''
+        if token is not None and self.backend == 'numpy':
+            # numpy collections only read their files, so processes share them.
+            return join(self.snapshot_root, token)
+        # chroma writes to its directory even when only queried, so every
+        # serving process opens a private copy.
+        path = join(self.snapshot_root, f'{token or "empty"}.reader-{os.getpid()}')
+        if exists(path):
+            shutil.rmtree(path)
+        if token is None:
+            os.makedirs(path)
+        else:
+            copy_store(join(self.snapshot_root, token), path, link=True)
+        return path
+
+    def release_store(self, path: str) -> None:
+        if '.reader-' in basename(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def refresh(self) -> None:
+        '''Pick up changes of the indexing process since the last check.
 
+        A new snapshot reopens the collection, while a new generation alone,
+        such as after thumbnails were recorded, only retires cached results.
+        '''
+        if self.indexing:
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+
+        if self.status_store is not None:
+            shared_generation = (self.status_store.get(self.dataset_id) or {}).get('generation')
+            if shared_generation != self.shared_generation:
+                self.shared_generation = shared_generation
+                self.manifest.invalidate_count()
+                self.generation = next(generations)
+
+        token = self.latest_snapshot()
+        if token == self.snapshot_token:
+            return
+        # checking out a snapshot copies the index, so requests keep searching
+        # the current collection while a single thread reloads it.
+        if self.refresh_lock.acquire(blocking=False):
+            Thread(target=self.reload_snapshot, args=(token,), daemon=True).start()
+
+    def reload_snapshot(self, token: str) -> None:
+        '''Open snapshot `token` and retire the collection it replaces.'''
         try:
-            image_files = []
-            for ext in self.image_extensions:
-                pattern = join(self.config['IMAGE_FOLDER'], f'*{ext}')
-                found_files = glob(pattern)
-                logger.debug(f'Found {len(found_files)} files with pattern `{pattern}`.')
-                image_files.extend(found_files)
-
-                pattern_upper = join(self.config['IMAGE_FOLDER'], f'*{ext.upper()}')
-                found_files_upper = glob(pattern_upper)
-                logger.debug(f'Found {len(found_files_upper)} files with pattern `{pattern_upper}`.')
-                image_files.extend(found_files_upper)
-
-            if not image_files:
-                logger.warning('No image files found in the image folder.')
+            try:
+                store_path = self.checkout_snapshot(token)
+            except OSError as snapshot_error:
+                # the snapshot may have been pruned meanwhile, the next check retries.
+                logger.warning(f'{snapshot_error=}')
                 return
 
-            logger.debug(f'total images: {len(image_files)}')
-            random.shuffle(image_files)
+            with self.index_lock:
+                if self.stop_event.is_set():
+                    self.release_store(store_path)
+                    return
+                stale_systems = self.release_chroma_systems(self.chroma_clients)
+                stale_collection = self.collection
+                stale_path = self.store_path
+                self.snapshot_token = token
+                self.store_path = store_path
+                self.chroma_clients = []
+                self.collection = self.open_collections()
+                self.chroma_client = self.chroma_clients[0] if self.chroma_clients else None
+                self.manifest.invalidate_count()
+                self.generation = next(generations)
+        finally:
+            self.refresh_lock.release()
 
-            self.config['PROCESSING_STATUS']['total_count'] = len(image_files)
-            self.config['PROCESSING_STATUS']['processed_count'] = 0
+        # searches may still hold the old collection, so give them time to finish.
+        def retire():
+            close_collection(stale_collection)
+            for system in stale_systems:
+                system.stop()
+            if stale_path != store_path:
+                self.release_store(stale_path)
 
-            batch_size = min(self.batch_size, 32)
-            for i in range(0, len(image_files), batch_size):
-                batch = image_files[i:i + batch_size]
-                try:
-                    self.process_images_batch(batch)
-                    logger.debug(f'processed batch {i//batch_size + 1} / {len(image_files)//batch_size + 1}')
-                except Exception as batch_error:
-                    logger.error(f'{batch_error=}', exc_info=True)
+        Timer(max(self.timeout, self.reload_interval), retire).start()
+        logger.debug(f'reloaded {self.db_name} from snapshot {token}')
+
+    def update_progress(self) -> Dict:
+        '''Derive throughput and eta of the running sync, and return a snapshot of the status.'''
+        with self.status_lock:
+            status = self.config['PROCESSING_STATUS']
+            if self.sync_started is not None:
+                elapsed = time.monotonic() - self.sync_started
+                throughput = status['processed_count'] / elapsed if elapsed > 0 else 0.0
+                remaining = status['total_count'] - status['processed_count']
+                status['elapsed_seconds'] = round(elapsed, 1)
+                status['throughput'] = round(throughput, 2)
+                status['eta_seconds'] = (
+                    round(remaining / throughput, 1)
+                    if status['is_processing'] and throughput > 0 else None
+                )
+            return dict(status, errors=list(status.get('errors', [])))
+
+    def record_error(self, error: Exception) -> None:
+        '''Keep a batch error in the status, so clients watching progress can see it.'''
+        with self.status_lock:
+            status = self.config['PROCESSING_STATUS']
+            errors = status.setdefault('errors', [])
+            errors.append(dict(message=f'{error!r}', time=time.time()))
+            del errors[:-MAX_STATUS_ERRORS]
+            status['error_count'] = status.get('error_count', 0) + 1
+        self.publish_status()
+
+    def publish_status(self, bump: bool = False) -> None:
+        if not self.indexing:
+            return
+        status = self.update_progress()
+        if self.status_events is not None:
+            self.status_events.publish(self.dataset_id, status)
+        if self.status_store is None:
+            return
+        try:
+            self.status_store.publish(self.dataset_id, status, bump)
+        except Exception as publish_error:
+            logger.warning(f'{publish_error=}')
+
+    def get_status(self) -> Dict:
+        '''Processing status, read from the shared store when another process indexes.'''
+        if self.status_store is not None and not self.indexing:
+            stored = self.status_store.get(self.dataset_id)
+            if stored is not None:
+                stored.pop('generation')
+                return stored
+        return self.config['PROCESSING_STATUS']
+
+    def close(self) -> None:
+        '''Stop syncing and release the collection's clients and memory.'''
+        self.stop_event.set()
+        # a running sync stops discovering files and drains what it queued.
+        with self.index_lock:
+            for system in self.release_chroma_systems(self.chroma_clients):
+                system.stop()
+            self.chroma_clients = []
+            self.chroma_client = None
+            close_collection(self.collection)
+            self.collection = None
+            self.embedder.close()
+            if not self.indexing:
+                self.release_store(self.store_path)
+        logger.debug(f'closed {self.db_name}')
+
+    def is_busy(self) -> bool:
+        return self.index_lock.locked()
+
+    def estimated_bytes(self) -> int:
+        '''Rough resident size of the loaded index: one float32 vector per image.'''
+        return self.manifest.get_count() * self.embedding_dimension * 4
+
+    def warm(self) -> None:
+        '''Load the index into memory with a throwaway query.'''
+        if self.collection.count() == 0:
+            return
+        probe = np.zeros(self.embedding_dimension, dtype=np.float32)
+        probe[0] = 1.0
+        self.collection.query(query_embeddings=[probe], n_results=1, include=['distances'])
+
+    def relative_name(self, image_path: str) -> str:
+        '''Name of an image relative to the image folder, as used in urls.'''
+        relative_path = os.path.relpath(image_path, self.config['IMAGE_FOLDER'])
+        if relative_path.startswith(os.pardir):
+            return basename(image_path)
+        return relative_path.replace(os.sep, '/')
+
+    def initialize_database(self, shard: int = None) -> None:
+        '''Sync the collection with the image folder.
+
+        Discovery streams files into a bounded queue that embedding workers
+        consume from, so indexing starts as soon as the first batch is found.
+        Files missing from the manifest or whose size or mtime changed are
+        (re-)embedded, and files that vanished from disk are deleted.
+
+        With `shard` set only the files owned by that shard are synced, which
+        lets separate processes build the shards of one dataset in parallel.
+        It defaults to the shard the manager was opened for.
+        '''
+        if self.stop_event.is_set() or not self.indexing:
+            return
+        if not self.index_lock.acquire(blocking=False):
+            logger.debug('sync already running, skipping.')
+            return
+
+        logger.debug('Starting database initialization')
+        shard = self.shard if shard is None else shard
+        status = self.config['PROCESSING_STATUS']
+        batches = Queue(maxsize=2 * self.max_in_flight)
+        workers = []
+        try:
+            batch, stale = {}, {}
+            scan_errors = []
+            stopped = False
+            scanned = (
+                (image_path, size, mtime)
+                for image_path, size, mtime in iter_image_files(
+                    self.config['IMAGE_FOLDER'], self.image_extensions, scan_errors
+                )
+                if self.owns(self.file_id(self.relative_name(image_path)), shard)
+            )
+
+            with self.manifest.scan() as scan:
+                while not stopped and (files := list(islice(scanned, SCAN_CHUNK))):
+                    entries, rejected = scan.lookup([image_path for image_path, _, _ in files])
+                    for image_path, size, mtime in files:
+                        if self.stop_event.is_set():
+                            stopped = True
+                            break
+                        entry = entries.get(image_path)
+                        if entry is not None and (entry[0], entry[1]) == (size, mtime):
+                            continue
+                        if rejected.get(image_path) == (size, mtime):
+                            continue
+                        if entry is not None:
+                            stale[image_path] = entry[2]
+
+                        if not workers:
+                            self.sync_started = time.monotonic()
+                            status['is_processing'] = True
+                            status['total_count'] = 0
+                            status['processed_count'] = 0
+                            status['error_count'] = 0
+                            status['errors'] = []
+                            workers = [
+                                Thread(target=self.consume_batches, args=(batches,), daemon=True)
+                                for _ in range(self.max_in_flight)
+                            ]
+                            for worker in workers:
+                                worker.start()
+                            self.publish_status()
+
+                        batch[image_path] = (size, mtime)
+                        status['total_count'] += 1
+                        if len(batch) >= self.batch_size:
+                            batches.put((batch, stale))
+                            batch, stale = {}, {}
+
+                if batch:
+                    batches.put((batch, stale))
+
+                # indexed files the scan didn't see no longer exist on disk, unless
+                # part of the folder couldn't be read, e.g. on a flaky network mount.
+                if scan_errors:
+                    logger.warning(f'sync: {len(scan_errors)} scan errors, keeping unseen files')
+                    self.record_error(scan_errors[0])
+                elif not stopped and not self.stop_event.is_set():
+                    # other shards' files were never looked at, so keep them.
+                    for unseen in scan.unseen():
+                        unseen = {path: file_id for path, file_id in unseen.items() if self.owns(file_id, shard)}
+                        if unseen:
+                            status['is_processing'] = True
+                            logger.debug(f'sync: removing {len(unseen)} files')
+                            self.remove_indexed_files(unseen)
+                    for unseen in scan.unseen_rejected():
+                        self.manifest.forget_rejected([
+                            path for path in unseen
+                            if self.owns(self.file_id(self.relative_name(path)), shard)
+                        ])
+
+            if not workers:
+                logger.debug('image folder is in sync.')
 
         except Exception as db_init_error:
             logger.error(f'{db_init_error}', exc_info=True)
         finally:
-            self.config['PROCESSING_STATUS']['is_processing'] = False
+            for _ in workers:
+                batches.put(None)
+            for worker in workers:
+                worker.join()
+            if self.snapshots and (self.collection_changed or self.latest_snapshot() is None):
+                try:
+                    self.write_snapshot()
+                    self.collection_changed = False
+                except Exception as snapshot_error:
+                    logger.error(f'{snapshot_error=}', exc_info=True)
+            status['is_processing'] = False
+            self.publish_status()
             self.initialization_complete = True
-            processed_count = self.config['PROCESSING_STATUS']['processed_count']
+            processed_count = status['processed_count']
             logger.info(f'db init: processed {processed_count} images.')
+            self.index_lock.release()
+
+    def consume_batches(self, batches: Queue) -> None:
+        while (item := batches.get()) is not None:
+            file_stats, stale = item
+            try:
+                self.remove_indexed_files(stale)
+                self.process_images_batch(list(file_stats), file_stats)
+                logger.debug(f'processed batch of {len(file_stats)}')
+            except Exception as batch_error:
+                logger.error(f'{batch_error=}', exc_info=True)
+                self.record_error(batch_error)
+
+    def bump_generation(self) -> None:
+        self.generation = next(generations)
+        self.publish_status(bump=True)
+
+    def remove_indexed_files(self, stale: Dict[str, str]) -> None:
+        '''Delete the given path -> id entries from the collection and manifest.'''
+        if not stale:
+            return
+        self.collection.delete(ids=list(stale.values()))
+        self.collection_changed = True
+        self.manifest.remove(list(stale))
+        self.bump_generation()
 
-    def process_images_batch(self, image_paths: List[str]) -> None:
+    def record_digests(self, digests: List[tuple]) -> None:
+        '''Store thumbnail digests, so new results pick up their thumbnails.'''
+        self.manifest.set_digests(digests)
+        self.bump_generation()
+
+    def reject_files(self, image_paths: List[str], manifest_rows: Dict[str, tuple]) -> None:
+        '''Record images the model can't decode, so syncs skip them until they change.'''
+        if not image_paths:
+            return
+        logger.warning(f'rejected {len(image_paths)} images: {image_paths[:5]}')
+        self.manifest.reject([
+            (image_path, manifest_rows[image_path][3], manifest_rows[image_path][4], 'undecodable')
+            for image_path in image_paths
+        ])
+
+    def get_indexed_entries(self, filenames: List[str]) -> Dict[str, tuple]:
+        '''Resolve which of `filenames` are already indexed with a single query.'''
+        if not filenames:
+            return {}
+        existing_entries = self.collection.get(
+            where={'filename': {'$in': list(set(filenames))}},
+            include=['metadatas'],
+        )
+        return {
+            metadata['filename']: (file_id, metadata)
+            for file_id, metadata in zip(existing_entries['ids'], existing_entries['metadatas'] or [])
+        }
+
+    def process_images_batch(self, image_paths: List[str], file_stats: Dict[str, tuple] = None) -> None:
         new_files = []
         new_ids = []
         new_metadata = []
+        manifest_rows = []
+
+        existing_entries = self.get_indexed_entries(
+            [self.relative_name(image_path) for image_path in image_paths]
+        )
 
         for image_path in image_paths:
             try:
-                filename = basename(image_path)
+                filename = self.relative_name(image_path)
                 logger.debug(f'processing image: {filename}')
 
-                existing_entries = self.collection.get(
-                    where={"filename": filename},
-                    include=["embeddings"]
-                )
+                if file_stats and image_path in file_stats:
+                    size, mtime = file_stats[image_path]
+                else:
+                    stat = os.stat(image_path)
+                    size, mtime = stat.st_size, stat.st_mtime
 
-                if existing_entries and len(existing_entries['ids']) > 0:
-                    if existing_entries.get('embeddings', [None])[0] is not None:
-                        logger.debug(f'embeddings: {filename}')
-                        continue
-                    else:
-                        logger.warning(f'No embeddings: {filename}')
+                if filename in existing_entries:
+                    logger.debug(f'embeddings: {filename}')
+                    file_id, metadata = existing_entries[filename]
+                    manifest_rows.append((image_path, filename, file_id, size, mtime, metadata))
+                    continue
 
-                file_id = str(uuid.uuid4())
-                new_files.append(image_path)
-                new_ids.append(file_id)
-                new_metadata.append({
+                file_id = self.file_id(filename)
+                metadata = {
                     'type': 'image',
+                    'source': self.source_of(image_path),
                     'filename': filename,
                     'original_path': image_path,
                     'processed': True
-                })
+                }
+                # guard against the same filename appearing twice in one batch.
+                existing_entries[filename] = (file_id, metadata)
+                new_files.append(image_path)
+                new_ids.append(file_id)
+                new_metadata.append(metadata)
+                manifest_rows.append((image_path, filename, file_id, size, mtime, metadata))
 
             except Exception as image_error:
                 logger.error(f'{image_error}', exc_info=True)
                 continue
 
+        if new_files:
+            rejected = []
+            embeddings = self.embedder.embed(new_files, rejected)
+            failed = {new_files[idx] for idx, embedding in enumerate(embeddings) if embedding is None}
+            if failed:
+                self.reject_files(
+                    [new_files[idx] for idx in rejected],
+                    {row[0]: row for row in manifest_rows},
+                )
+                kept = [idx for idx, embedding in enumerate(embeddings) if embedding is not None]
+                new_files = [new_files[idx] for idx in kept]
+                new_ids = [new_ids[idx] for idx in kept]
+                new_metadata = [new_metadata[idx] for idx in kept]
+                embeddings = [embeddings[idx] for idx in kept]
+                # files that failed for other reasons are retried by the next sync.
+                manifest_rows = [row for row in manifest_rows if row[0] not in failed]
+                self.record_error(RuntimeError(f'{len(failed)} of {len(image_paths)} images could not be embedded'))
+
         if new_files:
             try:
                 self.collection.add(
                     documents=new_files,
+                    embeddings=embeddings,
                     metadatas=new_metadata,
                     ids=new_ids
                 )
-                self.config['PROCESSING_STATUS']['processed_count'] += len(new_files)
+                self.collection_changed = True
+                with self.status_lock:
+                    self.config['PROCESSING_STATUS']['processed_count'] += len(new_files)
+                self.bump_generation()
             except Exception as batch_add_error:
                 logger.error(f'{batch_add_error=}', exc_info=True)
+                self.record_error(batch_add_error)
+                added = set(new_files)
+                manifest_rows = [row for row in manifest_rows if row[0] not in added]
+
+        self.manifest.upsert(manifest_rows)
+        if self.thumbnails is not None and manifest_rows:
+            self.thumbnails.submit([row[0] for row in manifest_rows], self.record_digests)
 
     def perform_search(
         self,
@@ -173,6 +846,14 @@ class DatabaseManager:
     ) -> Dict:
         logger.debug(f'search: {query_type=}, {query=}, {query_path=}')
 
+        self.refresh()
+        cache_key = (self.dataset_id, self.generation, query_type, query, query_path, limit)
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f'search cache hit: {cache_key}')
+                return cached
+
         try:
             if query_type == 'text':
                 if not query:
@@ -185,26 +866,162 @@ class DatabaseManager:
             elif query_type == 'image':
                 if not query_path:
                     raise ValueError('No query image provided.')
-                results = self.collection.query(
-                    query_texts=[query_path],
-                    n_results=limit,
-                    include=['metadatas', 'distances', 'documents']
-                )
+                query_embedding = self.get_stored_embedding(query_path)
+                if query_embedding is not None:
+                    results = self.collection.query(
+                        query_embeddings=[query_embedding],
+                        n_results=limit,
+                        include=['metadatas', 'distances', 'documents']
+                    )
+                else:
+                    results = self.collection.query(
+                        query_texts=[query_path],
+                        n_results=limit,
+                        include=['metadatas', 'distances', 'documents']
+                    )
             else:
                 raise ValueError('Invalid search type.')
 
-            return self._format_search_results(results, query_type, query_path, limit)
+            formatted = self._format_search_results(results, query_type, query_path, limit)
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, formatted)
+            return formatted
 
         except Exception as db_search_error:
             logger.error(f'{db_search_error=}', exc_info=True)
             raise
 
-    def get_image_url(self, doc):
-        db_name = self.db_name.split('_')[0]
-        output = f'/images/{filename}?dataset_id={db_name}'
-        if 'uploads' in doc:
-            output = f'/uploads/{filename}?dataset_id={db_name}'
-        return output
+    def embed_query(self, query_type: str, query: str = None, query_path: str = None):
+        '''Embedding for a single query, reusing stored vectors for indexed images.'''
+        if query_type == 'text':
+            if not query:
+                raise ValueError('No query input provided.')
+            return self.embedder.embed([query])[0]
+        elif query_type == 'image':
+            if not query_path:
+                raise ValueError('No query image provided.')
+            embedding = self.get_stored_embedding(query_path)
+            if embedding is None:
+                embedding = self.embedder.embed([query_path])[0]
+            return embedding
+        raise ValueError('Invalid search type.')
+
+    def search_by_embedding(
+        self,
+        embedding,
+        query_type: str,
+        query_path: str = None,
+        limit: int = None,
+    ) -> Dict:
+        self.refresh()
+        results = self.collection.query(
+            query_embeddings=[embedding],
+            n_results=limit,
+            include=['metadatas', 'distances', 'documents']
+        )
+        return self._format_search_results(results, query_type, query_path, limit)
+
+    def iter_batch_search(
+        self,
+        queries: List[Dict],
+        limit: int = None,
+        chunk_size: int = 256,
+    ):
+        '''Yield formatted results for each query, in order.
+
+        Each chunk of queries is embedded with one batched embedder call and
+        answered with a single multi-vector query. Queries are dicts with a
+        `type` of `text` (with `query`) or `image` (with `query_path`).
+        '''
+        self.refresh()
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+
+            embeddings = [None] * len(chunk)
+            pending = []
+            for idx, item in enumerate(chunk):
+                if item.get('type') == 'image':
+                    if not item.get('query_path'):
+                        continue
+                    embeddings[idx] = self.get_stored_embedding(item['query_path'])
+                    if embeddings[idx] is None:
+                        pending.append((idx, item['query_path']))
+                elif item.get('type') == 'text' and item.get('query'):
+                    pending.append((idx, item['query']))
+
+            if pending:
+                computed = self.embedder.embed([data for _, data in pending])
+                for (idx, _), embedding in zip(pending, computed):
+                    embeddings[idx] = embedding
+
+            valid = [idx for idx, embedding in enumerate(embeddings) if embedding is not None]
+            results = None
+            if valid:
+                results = self.collection.query(
+                    query_embeddings=[embeddings[idx] for idx in valid],
+                    n_results=limit,
+                    include=['metadatas', 'distances', 'documents']
+                )
+
+            positions = {idx: position for position, idx in enumerate(valid)}
+            for idx, item in enumerate(chunk):
+                query_type = item.get('type')
+                if idx not in positions:
+                    yield dict(query=item, error='Invalid or unembeddable query.')
+                    continue
+                position = positions[idx]
+                formatted = self._format_search_results(
+                    {key: [results[key][position]] for key in ('documents', 'metadatas', 'distances')},
+                    query_type,
+                    item.get('query_path'),
+                    limit,
+                )
+                yield dict(query=item, **formatted)
+
+    def perform_batch_search(self, queries: List[Dict], limit: int = None) -> List[Dict]:
+        try:
+            return list(self.iter_batch_search(queries, limit))
+        except Exception as db_batch_search_error:
+            logger.error(f'{db_batch_search_error=}', exc_info=True)
+            raise
+
+    def get_stored_embedding(self, image_path: str):
+        '''Return the indexed embedding for `image_path`, if it has one.'''
+        existing_entries = self.collection.get(
+            where={'original_path': image_path},
+            include=['embeddings'],
+            limit=1,
+        )
+        embeddings = existing_entries.get('embeddings')
+        if embeddings is None or len(embeddings) == 0 or embeddings[0] is None:
+            return None
+        logger.debug(f'stored embedding: {image_path}')
+        return embeddings[0]
+
+    def source_of(self, image_path: str) -> str:
+        '''`upload` for query images saved through the app, `image` otherwise.'''
+        upload_folder = os.path.abspath(self.config['UPLOAD_FOLDER'])
+        if os.path.abspath(image_path).startswith(upload_folder + os.sep):
+            return 'upload'
+        return 'image'
+
+    def upload_names(self) -> set:
+        '''Names in the upload folder, listed once and then kept up to date by `add_upload`.'''
+        if self.uploads is None:
+            with self.status_lock:
+                if self.uploads is None:
+                    self.uploads = set(os.listdir(self.config['UPLOAD_FOLDER']))
+        return self.uploads
+
+    def add_upload(self, filename: str) -> None:
+        self.upload_names().add(filename)
+
+    def get_image_url(self, filename: str, metadata: Dict) -> str:
+        # rows indexed before `source` was recorded fall back to the upload index.
+        source = metadata.get('source')
+        is_upload = source == 'upload' if source else filename in self.upload_names()
+        route = 'uploads' if is_upload else 'images'
+        return f'/{route}/{filename}?dataset_id={self.dataset_id}'
 
     def _format_search_results(
         self,
@@ -225,21 +1042,16 @@ class DatabaseManager:
             if query_type == 'image' and doc == query_path:
                 continue
 
-            filename = basename(doc)
+            filename = metadata.get('filename') or basename(doc)
             if filename in seen_files:
                 continue
 
             seen_files.add(filename)
 
-            is_upload = exists(join(self.config['UPLOAD_FOLDER'], filename))
-            db_name = self.db_name.split('_')[0]
-            url = f"/uploads/{filename}?dataset_id={db_name}" if is_upload \
-                else f"/images/{filename}?dataset_id={db_name}"
-
             result = {
                 'path': doc,
                 'filename': filename,
-                'url': url,
+                'url': self.get_image_url(filename, metadata),
                 'distance': float(distance),
                 'metadata': metadata,
                 'rank': idx + 1
@@ -253,4 +1065,11 @@ class DatabaseManager:
         for idx, result in enumerate(unique_results):
             result['rank'] = idx + 1
 
+        if self.thumbnails is not None and unique_results:
+            db_name = self.dataset_id
+            digests = self.manifest.get_digests([result['path'] for result in unique_results])
+            for result in unique_results:
+                if result['path'] in digests:
+                    result['thumbnails'] = self.thumbnails.urls(digests[result['path']], db_name)
+
         return dict(results=unique_results, tital=len(unique_results), query_type=query_type)
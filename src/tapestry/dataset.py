@@ -12,6 +12,7 @@ class DatasetConfig:
         self.name = dataset_id
         self.data_path = data_path
         self.image_folder = os.path.join(data_path, 'images')
+        self.thumbnail_folder = os.path.join(data_path, 'thumbnails')
         self.db_path = os.path.join(data_path, 'chroma_db')
         self.db_name = f'{dataset_id}_images'
 
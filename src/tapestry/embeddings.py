@@ -1,121 +1,346 @@
 import base64
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 import io
+from itertools import repeat
 import json
 import logging
+import multiprocessing
 import numpy as np
 import os
 from PIL import Image
 import requests
-from typing import Any, Dict, List
+import struct
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, List, Optional
+
+from tapestry.cache import EmbeddingCache, LRUCache, hash_file
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# binary batches are framed as MAGIC followed by (uint32 length, bytes) pairs.
+BINARY_BATCH_MAGIC = b'TPSTRY\x00\x01'
+
+# errors of decoding bytes already in memory, which only a broken image
+# causes. OSError covers unidentified and truncated images.
+DECODE_ERRORS = (OSError, EOFError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+def resize_image_bytes(data: bytes, image_size: tuple) -> bytes:
+    '''Decode an image and return it as a PNG resized to `image_size`.'''
+    with Image.open(io.BytesIO(data)) as image:
+        # jpeg can decode at a reduced scale close to the target size.
+        image.draft('RGB', tuple(image_size))
+        image = image.convert('RGB').resize(tuple(image_size))
+        image_bytes = io.BytesIO()
+        image.save(image_bytes, format='PNG', compress_level=1)
+        return image_bytes.getvalue()
+
+def read_image_bytes(image_path: str, image_size: tuple = None) -> bytes:
+    '''Return the original file bytes, or a PNG resized to `image_size`.'''
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    return resize_image_bytes(data, image_size) if image_size else data
+
 def process_image(image_path: str, image_size:tuple) -> str:
-    try:
-        with Image.open(image_path).convert('RGB') as image:
-            if image_size:
-                image = image.resize(image_size)
-            image_bytes = io.BytesIO()
-            image.save(image_bytes, format='PNG')
-            image_bytes = image_bytes.getvalue()
-            return base64.b64encode(image_bytes).decode('utf-8')
-    except Exception as image_processing_exception:
-        log.error(f"{image_processing_exception=}")
-        raise
+    return base64.b64encode(read_image_bytes(image_path, image_size)).decode('utf-8')
 
-def get_embeddings(
+def encode_image(image_path: str, image_size: tuple, transport: str):
+    '''Request payload for one image, or None if it can't be decoded.
+
+    The file is read before it is decoded, so I/O errors, such as timeouts
+    on a network mount, propagate and fail the batch, which a later sync
+    retries, rather than rejecting the image for good.
+    '''
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    if image_size:
+        try:
+            data = resize_image_bytes(data, image_size)
+        except DECODE_ERRORS as image_decode_error:
+            log.error(f"{image_path}: {image_decode_error=}")
+            return None
+    if transport == 'binary':
+        return data
+    return base64.b64encode(data).decode('utf-8')
+
+@lru_cache(maxsize=None)
+def get_preprocess_executor(workers: int) -> Executor:
+    '''Process pool shared by every embedder for image decoding and resizing.'''
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+def pack_images(blobs: List[bytes]) -> bytes:
+    frames = [BINARY_BATCH_MAGIC]
+    for blob in blobs:
+        frames.append(struct.pack('>I', len(blob)))
+        frames.append(blob)
+    return b''.join(frames)
+
+def split_payloads(payloads: List, max_bytes: int = None) -> List[List]:
+    '''Group payloads into consecutive runs of at most `max_bytes` each.
+
+    A payload larger than `max_bytes` is sent on its own.
+    '''
+    if not max_bytes:
+        return [payloads]
+    chunks, chunk, size = [], [], 0
+    for payload in payloads:
+        if chunk and size + len(payload) > max_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(payload)
+        size += len(payload)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def parse_embeddings(response: requests.Response, key: str) -> List[Optional[np.ndarray]]:
+    '''Embeddings in request order, with None for items the model server rejected.'''
+    if response.status_code != 200:
+        raise Exception(f"error: {response.text=}")
+
+    response_data = response.json()
+    if not (isinstance(response_data, dict) and 'body' in response_data):
+        raise KeyError("No 'body' field in response.")
+
+    body_data = json.loads(response_data['body'])
+    if key not in body_data:
+        raise KeyError(f"No '{key}' field in response body.")
+
+    return [
+        None if embedding is None else np.asarray(embedding, dtype=np.float32)
+        for embedding in body_data[key]
+    ]
+
+def get_batch_embeddings(
         embedding_model_address: str,
-        image_path: str = None,
-        text_string: str = None,
+        image_paths: List[str] = None,
+        text_strings: List[str] = None,
         embedding_dim: int = 512,
         image_size: tuple = (1024,1024),
         timeout: int = 10,
+        session: requests.Session = None,
+        transport: str = 'base64',
+        preprocess_executor: Executor = None,
+        max_request_bytes: int = None,
     ) -> Dict[str, np.ndarray]:
+    '''Embed images and texts with one stacked request per modality.
+
+    Images are split over several requests when their payloads together
+    exceed `max_request_bytes`, which keeps them within the model server's
+    request size limit. Images that can't be decoded, here or by the model
+    server, get None instead of an embedding.
+    '''
+    http = session or requests
     embeddings = {}
     try:
-        if image_path is not None:
-
-            response = requests.post(
-                embedding_model_address,
-                json=dict(image=process_image(image_path, image_size)),
-                timeout=timeout
-            )
-
-            if response.status_code == 200:
-                response_data = response.json()
-                if isinstance(response_data, dict) and 'body' in response_data:
-                    body_data = json.loads(response_data['body'])
-                    if 'image' in body_data:
-                        embedding = np.array(body_data['image'][0], dtype=np.float32)
-                        embeddings['image'] = embedding
-                        log.info(f'{image_path}')
-                    else:
-                        raise KeyError("No 'image' field in response body.")
-                else:
-                    raise KeyError("No 'body' field in response.")
+        if image_paths:
+            if preprocess_executor is not None:
+                payloads = list(preprocess_executor.map(
+                    encode_image, image_paths, repeat(image_size), repeat(transport)
+                ))
             else:
-                raise Exception(f"error: {response.text=}")
+                payloads = [encode_image(path, image_size, transport) for path in image_paths]
 
-        if text_string is not None:
+            image_embeddings = []
+            for chunk in split_payloads([payload for payload in payloads if payload is not None], max_request_bytes):
+                if transport == 'binary':
+                    response = http.post(
+                        embedding_model_address,
+                        data=pack_images(chunk),
+                        headers={'Content-Type': 'application/octet-stream'},
+                        timeout=timeout
+                    )
+                else:
+                    response = http.post(
+                        embedding_model_address,
+                        json=dict(image=chunk),
+                        timeout=timeout
+                    )
+                image_embeddings.extend(parse_embeddings(response, 'image'))
+            received = iter(image_embeddings)
+            embeddings['image'] = [None if payload is None else next(received) for payload in payloads]
+            log.info(f'embedded {len(image_paths)} images')
 
-            response = requests.post(
+        if text_strings:
+            response = http.post(
                 embedding_model_address,
-                json=dict(text=text_string),
+                json=dict(text=list(text_strings)),
                 timeout=timeout
             )
-
-            if response.status_code == 200:
-                response_data = response.json()
-                if isinstance(response_data, dict) and 'body' in response_data:
-                    body_data = json.loads(response_data['body'])
-                    if 'text' in body_data:
-                        embedding = np.array(body_data['text'][0], dtype=np.float32)
-                        embeddings['text'] = embedding
-                        log.info(f'{text_string}')
-                    else:
-                        raise KeyError("No 'text' field in response body.")
-                else:
-                    raise KeyError("No 'body' field in response.")
-            else:
-                raise Exception(f"error: {response.text=}")
+            embeddings['text'] = np.stack(parse_embeddings(response, 'text'))
+            log.info(f'embedded {len(text_strings)} texts')
 
     except requests.exceptions.RequestException as embedding_exception:
         log.error(f"{embedding_exception=}")
 
     return embeddings
 
+def get_embeddings(
+        embedding_model_address: str,
+        image_path: str = None,
+        text_string: str = None,
+        embedding_dim: int = 512,
+        image_size: tuple = (1024,1024),
+        timeout: int = 10,
+    ) -> Dict[str, np.ndarray]:
+    embeddings = get_batch_embeddings(
+        embedding_model_address,
+        image_paths=[image_path] if image_path is not None else None,
+        text_strings=[text_string] if text_string is not None else None,
+        embedding_dim=embedding_dim,
+        image_size=image_size,
+        timeout=timeout,
+    )
+    return {key: value[0] for key, value in embeddings.items()}
+
+def make_session(pool_size: int) -> requests.Session:
+    '''Create a keep-alive session able to hold `pool_size` open connections.'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class Embedder:
     def __init__(
         self,
         embedding_model_address:str,
         embedding_dimension:int,
         embedding_image_size:tuple,
+        timeout:int = 10,
+        batch_size:int = 32,
+        max_in_flight:int = 4,
+        transport:str = 'base64',
+        cache:EmbeddingCache = None,
+        preprocess_workers:int = 0,
+        text_cache:LRUCache = None,
+        max_request_bytes:int = None,
     ):
         self.embedding_model_address = embedding_model_address
         self.embedding_dimension = embedding_dimension
-        self.embedding_image_size = embedding_image_size
+        self.embedding_image_size = tuple(embedding_image_size) if embedding_image_size else None
+        self.timeout = timeout
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.transport = transport
+        self.max_request_bytes = max_request_bytes
+        self.cache = cache
+        self.text_cache = text_cache
+        # decoding only happens client-side when images are resized or base64 encoded.
+        self.preprocess_executor = None
+        if preprocess_workers > 0 and (self.embedding_image_size or self.transport != 'binary'):
+            self.preprocess_executor = get_preprocess_executor(preprocess_workers)
+        self.session = make_session(self.max_in_flight)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight,
+            thread_name_prefix='embedder',
+        )
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    def request_embeddings(self, key: str, items: List[str]) -> np.ndarray:
+        emb_dict = get_batch_embeddings(
+            self.embedding_model_address,
+            image_paths=items if key == 'image' else None,
+            text_strings=items if key == 'text' else None,
+            embedding_dim=self.embedding_dimension,
+            image_size=self.embedding_image_size,
+            timeout=self.timeout,
+            session=self.session,
+            transport=self.transport,
+            preprocess_executor=self.preprocess_executor,
+            max_request_bytes=self.max_request_bytes,
+        )
+        return emb_dict[key]
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        '''Embed prompts, answering repeated ones from the in-memory text cache.'''
+        if self.text_cache is None:
+            return self.request_embeddings('text', texts)
+
+        # the model address names the model, so it keeps entries of
+        # different models apart in a shared cache.
+        keys = [(self.embedding_model_address, text) for text in texts]
+        embeddings = [self.text_cache.get(key) for key in keys]
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            pending = list(dict.fromkeys(texts[idx] for idx in missing))
+            computed = dict(zip(pending, self.request_embeddings('text', pending)))
+            for text, embedding in computed.items():
+                self.text_cache.put((self.embedding_model_address, text), embedding)
+            for idx in missing:
+                embeddings[idx] = computed[texts[idx]]
+
+        log.debug(f'text cache: {len(texts) - len(missing)}/{len(texts)} hits')
+        return np.stack(embeddings)
+
+    def embed_batch(self, key: str, items: List[str]) -> np.ndarray:
+        if key == 'text':
+            return self.embed_texts(items)
+        if self.cache is None:
+            return self.request_embeddings(key, items)
+
+        digests = [hash_file(path) for path in items]
+        embeddings = self.cache.get_many(digests)
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self.request_embeddings(key, [items[idx] for idx in missing])
+            computed_keys = [digests[idx] for idx, embedding in zip(missing, computed) if embedding is not None]
+            self.cache.put_many(computed_keys, [embedding for embedding in computed if embedding is not None])
+            for idx, embedding in zip(missing, computed):
+                embeddings[idx] = embedding
+
+        log.debug(f'embedding cache: {len(items) - len(missing)}/{len(items)} hits')
+        return embeddings
 
     def __call__(self, input: List[str]) -> List[np.ndarray]:
-        embeddings = []
+        return [embedding for embedding in self.embed(input) if embedding is not None]
+
+    def embed(self, input: List[str], rejected: List[int] = None) -> List[Optional[np.ndarray]]:
+        '''Embed `input` in order, with None for items that failed.
 
-        for data in input:
+        Indices of images that failed because they can't be decoded, rather
+        than because a request failed, are appended to `rejected`.
+        '''
+        image_indices, image_paths = [], []
+        text_indices, text_strings = [], []
+
+        for idx, data in enumerate(input):
+            if os.path.isfile(data):
+                image_indices.append(idx)
+                image_paths.append(data)
+            else:
+                text_indices.append(idx)
+                text_strings.append(data)
+
+        # split each modality into request-sized chunks and keep at most
+        # `max_in_flight` of them running against the model server.
+        futures = []
+        for key, indices, items in (
+            ('image', image_indices, image_paths),
+            ('text', text_indices, text_strings),
+        ):
+            for i in range(0, len(items), self.batch_size):
+                future = self.executor.submit(
+                    self.embed_batch, key, items[i:i + self.batch_size]
+                )
+                futures.append((indices[i:i + self.batch_size], future))
+
+        embeddings = [None] * len(input)
+        for indices, future in futures:
             try:
-                if os.path.isfile(data):
-                    emb_dict = get_embeddings(
-                        image_path=data,
-                        embedding_model_address=self.embedding_model_address,
-                        embedding_dim=self.embedding_dimension,
-                        image_size=self.embedding_image_size
-                    )
-                    embeddings.append(emb_dict['image'])
-                else:
-                    emb_dict = get_embeddings(
-                        text_string=data,
-                        embedding_model_address=self.embedding_model_address,
-                        embedding_dim=self.embedding_dimension,
-                    )
-                    embeddings.append(emb_dict['text'])
+                for idx, embedding in zip(indices, future.result()):
+                    embeddings[idx] = embedding
+                    if embedding is None and rejected is not None:
+                        rejected.append(idx)
             except Exception as embedding_exception:
                 log.error(f"{embedding_exception=}")
 
@@ -0,0 +1,79 @@
+from queue import Empty, Full, Queue
+from threading import Lock
+from typing import Dict, List, Optional
+
+class Subscription:
+    '''Queue of status events for one listener, dropping the oldest when it falls behind.'''
+    def __init__(self, broker: 'StatusBroker', dataset_id: str, maxsize: int = 16):
+        self.broker = broker
+        self.dataset_id = dataset_id
+        self.queue: Queue = Queue(maxsize=maxsize)
+
+    def put(self, event: Dict) -> None:
+        # progress events supersede each other, so a slow client only needs the latest.
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+
+    def get(self, timeout: float = None) -> Optional[Dict]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+
+class StatusBroker:
+    '''In-process pub/sub for per-dataset processing status.
+
+    The indexing thread publishes after every batch and listeners, such as
+    server-sent event streams, subscribe per dataset. The last event of
+    each dataset is kept, so a status can be read without a subscription.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.subscriptions: Dict[str, set] = {}
+        self.latest: Dict[str, Dict] = {}
+
+    def publish(self, dataset_id: str, event: Dict) -> None:
+        with self.lock:
+            if self.latest.get(dataset_id) == event:
+                return
+            self.latest[dataset_id] = event
+            subscriptions = list(self.subscriptions.get(dataset_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, dataset_id: str) -> Subscription:
+        subscription = Subscription(self, dataset_id)
+        with self.lock:
+            self.subscriptions.setdefault(dataset_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.dataset_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.dataset_id]
+
+    def subscribed(self) -> List[str]:
+        '''Datasets that currently have listeners.'''
+        with self.lock:
+            return list(self.subscriptions)
+
+    def get_latest(self, dataset_id: str) -> Optional[Dict]:
+        with self.lock:
+            return self.latest.get(dataset_id)
+
+    def forget(self, dataset_id: str) -> None:
+        with self.lock:
+            self.latest.pop(dataset_id, None)
@@ -0,0 +1,135 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import hydra
+import logging
+from omegaconf import DictConfig, OmegaConf
+import time
+from typing import Dict
+
+from tapestry.app import DATA_DIR, build_db_manager, build_embedding_cache
+from tapestry.dataset import DatasetManager
+from tapestry.status import StatusStore
+from tapestry.thumbnails import ThumbnailCache
+
+logger = logging.getLogger(__name__)
+
+def run_indexer(config: Dict, poll_interval: float = 1.0) -> None:
+    '''Own indexing for every dataset: sync on startup, on request and every `sync_interval`.
+
+    Up to `indexer_workers` datasets sync at once, so a long initial index
+    doesn't hold up the others. Managers are only opened for the duration of
+    a sync, and each sync publishes a snapshot of its collection for the
+    serving processes.
+    '''
+    cfg = OmegaConf.create(config)
+    dataset_manager = DatasetManager(str(DATA_DIR))
+    status_store = StatusStore(cfg.status_db_path)
+    embedding_cache = build_embedding_cache(cfg)
+    thumbnail_executor = None
+    if cfg.thumbnail_sizes:
+        thumbnail_executor = ThreadPoolExecutor(
+            max_workers=cfg.thumbnail_workers,
+            thread_name_prefix='thumbnails',
+        )
+
+    sync_executor = ThreadPoolExecutor(
+        max_workers=cfg.indexer_workers,
+        thread_name_prefix='indexer',
+    )
+
+    def sync(dataset_id: str, dataset) -> None:
+        thumbnails = None
+        if cfg.thumbnail_sizes:
+            thumbnails = ThumbnailCache(
+                dataset.thumbnail_folder,
+                cfg.thumbnail_sizes,
+                cfg.thumbnail_quality,
+                thumbnail_executor,
+            )
+        try:
+            db_manager = build_db_manager(
+                cfg,
+                dataset_id,
+                dataset,
+                embedding_cache,
+                thumbnails,
+                auto_initialize=False,
+                status_store=status_store,
+                snapshots=True,
+            )
+            try:
+                db_manager.initialize_database()
+            finally:
+                db_manager.close()
+        except Exception as indexer_error:
+            logger.error(f'{dataset_id}: {indexer_error=}', exc_info=True)
+        synced_at[dataset_id] = time.monotonic()
+
+    synced_at: Dict[str, float] = {}
+    running: Dict[str, Future] = {}
+    pending = set()
+    while True:
+        dataset_manager.refresh()
+        # requests for a dataset that is syncing are kept until it's done.
+        pending.update(status_store.take_sync_requests())
+        now = time.monotonic()
+        for dataset_id, future in list(running.items()):
+            if future.done():
+                del running[dataset_id]
+
+        for dataset_id in dataset_manager.datasets:
+            if dataset_id in running:
+                continue
+            last = synced_at.get(dataset_id)
+            if last is None or (cfg.sync_interval and now - last >= cfg.sync_interval):
+                pending.add(dataset_id)
+
+        for dataset_id in sorted(pending - set(running)):
+            pending.discard(dataset_id)
+            dataset = dataset_manager.get_dataset(dataset_id)
+            if not dataset:
+                continue
+            running[dataset_id] = sync_executor.submit(sync, dataset_id, dataset)
+
+        time.sleep(poll_interval)
+
+@hydra.main(version_base=None, config_path='config', config_name='app')
+def main(cfg: DictConfig):
+    '''Build one dataset, or one shard of it, outside of the web app.
+
+    Start one process per shard to index a sharded dataset in parallel:
+
+        python -m tapestry.index +dataset_id=photos +shard=0
+
+    The embedding cache is only safe for a single writer, so shard builds
+    run without it, and an unsharded build only reads it while a server or
+    indexer process is writing to it.
+    '''
+    dataset_id = cfg.dataset_id
+    shard = cfg.get('shard')
+    dataset = DatasetManager(str(DATA_DIR)).get_dataset(dataset_id)
+    if not dataset:
+        raise ValueError(f'{dataset_id=}')
+
+    thumbnails = None
+    if cfg.thumbnail_sizes:
+        thumbnails = ThumbnailCache(dataset.thumbnail_folder, cfg.thumbnail_sizes, cfg.thumbnail_quality)
+
+    shards = cfg.db_shard_counts.get(dataset_id, cfg.db_shards)
+    if shard is not None and not 0 <= shard < shards:
+        raise ValueError(f'{shard=}, {shards=}')
+
+    # a shard build only opens its own shard, not every shard's index.
+    db_manager = build_db_manager(
+        cfg,
+        dataset_id,
+        dataset,
+        build_embedding_cache(cfg) if shard is None else None,
+        thumbnails,
+        auto_initialize=False,
+        shard=shard,
+    )
+    db_manager.initialize_database()
+    logger.info(f'{dataset_id} shard {shard}: {db_manager.collection.count()} images indexed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import json
+import sqlite3
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+class ManifestScan:
+    '''One sync's comparison of the image folder with the manifest.
+
+    Scanned paths are looked up a chunk at a time and recorded in a
+    temporary table, which sqlite keeps on disk, so comparing a folder of
+    any size takes bounded memory. Files the scan never saw are paged
+    through afterwards.
+    '''
+    def __init__(self, db_path: str, page_size: int = 1000):
+        self.page_size = page_size
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TEMP TABLE scanned (path TEXT PRIMARY KEY)')
+
+    def __enter__(self) -> 'ManifestScan':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.conn.close()
+
+    def lookup(self, paths: List[str]) -> Tuple[Dict[str, Tuple[int, float, str]], Dict[str, Tuple[int, float]]]:
+        '''Mark `paths` as seen and return their (size, mtime, id) entries and rejections.'''
+        cursor = self.conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO scanned VALUES (?)', [(path,) for path in paths])
+        self.conn.commit()
+        placeholders = ', '.join('?' * len(paths))
+        cursor.execute(f'SELECT path, size, mtime, id FROM files WHERE path IN ({placeholders})', paths)
+        entries = {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+        cursor.execute(f'SELECT path, size, mtime FROM rejected WHERE path IN ({placeholders})', paths)
+        rejected = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        return entries, rejected
+
+    def unseen(self) -> Iterator[Dict[str, str]]:
+        '''Pages of {path: id} for indexed files the scan didn't see.'''
+        after = 0
+        while True:
+            rows = self.conn.execute(
+                '''
+                SELECT seq, path, id FROM files
+                WHERE seq > ? AND NOT EXISTS (SELECT 1 FROM scanned WHERE scanned.path = files.path)
+                ORDER BY seq LIMIT ?
+                ''',
+                (after, self.page_size)
+            ).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield {row[1]: row[2] for row in rows}
+
+    def unseen_rejected(self) -> Iterator[List[str]]:
+        '''Pages of rejected paths the scan didn't see.'''
+        after = 0
+        while True:
+            rows = self.conn.execute(
+                '''
+                SELECT rowid, path FROM rejected
+                WHERE rowid > ? AND NOT EXISTS (SELECT 1 FROM scanned WHERE scanned.path = rejected.path)
+                ORDER BY rowid LIMIT ?
+                ''',
+                (after, self.page_size)
+            ).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield [row[1] for row in rows]
+
+class ImageManifest:
+    '''Catalog of every indexed file with the size and mtime it was indexed at.
+
+    Rows keep their `seq` for as long as the file stays indexed, which makes
+    `seq` usable as a stable pagination cursor for the gallery.
+    '''
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.count_lock = Lock()
+        self.count = None
+        self.init_db()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM pragma_table_info('files')")
+            columns = {row[0] for row in cursor.fetchall()}
+            legacy = bool(columns) and 'seq' not in columns
+            if legacy:
+                cursor.execute('ALTER TABLE files RENAME TO files_legacy')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    path TEXT NOT NULL UNIQUE,
+                    filename TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL,
+                    metadata TEXT,
+                    digest TEXT
+                )
+            ''')
+            if columns and not legacy and 'digest' not in columns:
+                cursor.execute('ALTER TABLE files ADD COLUMN digest TEXT')
+            # files the model couldn't decode, skipped until they change.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rejected (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    error TEXT
+                )
+            ''')
+
+            # the collection layout (backend and shard count) the files were indexed into.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+
+            if legacy:
+                cursor.execute('''
+                    INSERT INTO files (path, filename, id, size, mtime)
+                    SELECT path, filename, id, size, mtime FROM files_legacy
+                ''')
+                cursor.execute('DROP TABLE files_legacy')
+            conn.commit()
+
+    def use_layout(self, layout: str, empty: bool = False) -> bool:
+        '''Record the collection layout files are indexed into.
+
+        The catalog describes one collection, so when the layout changed, or
+        the collection is `empty` while files are catalogued, it is cleared
+        and the next sync indexes every file again. Returns whether it was.
+        '''
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            row = cursor.execute("SELECT value FROM settings WHERE key = 'layout'").fetchone()
+            stale = (row is not None and row[0] != layout) or (
+                empty and cursor.execute('SELECT 1 FROM files LIMIT 1').fetchone() is not None
+            )
+            if stale:
+                cursor.execute('DELETE FROM files')
+            cursor.execute("INSERT OR REPLACE INTO settings VALUES ('layout', ?)", (layout,))
+            conn.commit()
+        if stale:
+            self.invalidate_count()
+        return stale
+
+    def scan(self) -> ManifestScan:
+        return ManifestScan(self.db_path)
+
+    def upsert(self, rows: Iterable[Tuple[str, str, str, int, float, Dict]]) -> None:
+        '''Insert or update (path, filename, id, size, mtime, metadata) rows.'''
+        rows = list(rows)
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                '''
+                INSERT INTO files (path, filename, id, size, mtime, metadata)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    filename = excluded.filename,
+                    id = excluded.id,
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    metadata = excluded.metadata,
+                    digest = CASE
+                        WHEN files.size = excluded.size AND files.mtime = excluded.mtime
+                        THEN files.digest
+                    END
+                ''',
+                [(*row[:5], json.dumps(row[5])) for row in rows]
+            )
+            cursor.executemany('DELETE FROM rejected WHERE path = ?', [(row[0],) for row in rows])
+            conn.commit()
+        self.invalidate_count()
+
+    def reject(self, rows: Iterable[Tuple[str, int, float, str]]) -> None:
+        '''Record (path, size, mtime, error) rows for files that can't be embedded.'''
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('INSERT OR REPLACE INTO rejected VALUES (?, ?, ?, ?)', rows)
+            conn.commit()
+
+    def forget_rejected(self, paths: List[str]) -> None:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('DELETE FROM rejected WHERE path = ?', [(path,) for path in paths])
+            conn.commit()
+
+    def remove(self, paths: List[str]) -> None:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in paths])
+            conn.commit()
+        self.invalidate_count()
+
+    def set_digests(self, rows: Iterable[Tuple[str, str]]) -> None:
+        '''Record the content hash of each (digest, path) pair.'''
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('UPDATE files SET digest = ? WHERE path = ?', rows)
+            conn.commit()
+
+    def get_digests(self, paths: List[str]) -> Dict[str, str]:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'''
+                SELECT path, digest FROM files
+                WHERE digest IS NOT NULL AND path IN ({', '.join('?' * len(paths))})
+                ''',
+                paths
+            )
+            return dict(cursor.fetchall())
+
+    def get_files(self, paths: List[str]) -> Dict[str, Dict]:
+        '''Catalog entries for the indexed ones among `paths`.'''
+        if not paths:
+            return {}
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'''
+                SELECT path, filename, metadata, digest FROM files
+                WHERE path IN ({', '.join('?' * len(paths))})
+                ''',
+                paths
+            )
+            return {
+                row[0]: dict(
+                    filename=row[1],
+                    metadata=json.loads(row[2]) if row[2] else {},
+                    digest=row[3],
+                )
+                for row in cursor.fetchall()
+            }
+
+    def invalidate_count(self) -> None:
+        with self.count_lock:
+            self.count = None
+
+    def get_count(self) -> int:
+        '''Number of indexed files, cached until the next write.'''
+        with self.count_lock:
+            if self.count is None:
+                with sqlite3.connect(self.db_path) as conn:
+                    self.count = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            return self.count
+
+    def list_files(self, after: Optional[int] = None, limit: int = 100, offset: int = 0) -> List[Dict]:
+        '''Page through indexed files in index order, starting after cursor `after`.'''
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT seq, path, filename, metadata, digest
+                FROM files
+                WHERE seq > ?
+                ORDER BY seq
+                LIMIT ? OFFSET ?
+                ''',
+                (after or 0, limit, offset)
+            )
+            return [
+                dict(
+                    seq=row[0],
+                    path=row[1],
+                    filename=row[2],
+                    metadata=json.loads(row[3]) if row[3] else {},
+                    digest=row[4],
+                )
+                for row in cursor.fetchall()
+            ]
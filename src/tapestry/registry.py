@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+from threading import Lock, Thread
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from tapestry.database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+class _Entry:
+    def __init__(self):
+        self.lock = Lock()
+        self.manager: Optional[DatabaseManager] = None
+        self.last_used = time.monotonic()
+        # requests currently using the manager, which is never evicted while held.
+        self.leases = 0
+
+class ManagerRegistry:
+    '''One DatabaseManager per dataset, created on first use and evicted when idle.
+
+    Creation is serialized per dataset, so concurrent first requests share a
+    single manager. Whenever more than `max_loaded` managers are open, or
+    their estimated size exceeds `max_bytes`, the least recently used ones
+    that are not syncing, not leased and have been idle for `idle_seconds`
+    are closed. Requests hold a lease for as long as they use a manager.
+    '''
+    def __init__(
+        self,
+        factory: Callable[[str], DatabaseManager],
+        max_loaded: int = None,
+        max_bytes: int = None,
+        idle_seconds: float = 60,
+    ):
+        self.factory = factory
+        self.max_loaded = max_loaded
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.entries: OrderedDict[str, _Entry] = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, dataset_id: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(dataset_id)
+            return entry is not None and entry.manager is not None
+
+    def loaded(self) -> List[str]:
+        with self.lock:
+            return [key for key, entry in self.entries.items() if entry.manager is not None]
+
+    def get(self, dataset_id: str) -> DatabaseManager:
+        '''The dataset's manager, which may be evicted once idle; see `acquire` to hold it.'''
+        return self._get(dataset_id, lease=False)
+
+    def acquire(self, dataset_id: str) -> DatabaseManager:
+        '''The dataset's manager, kept loaded until a matching `release`.'''
+        return self._get(dataset_id, lease=True)
+
+    def release(self, dataset_id: str) -> None:
+        with self.lock:
+            entry = self.entries.get(dataset_id)
+            if entry is not None and entry.leases > 0:
+                entry.leases -= 1
+                entry.last_used = time.monotonic()
+        self.evict()
+
+    @contextmanager
+    def lease(self, dataset_id: str) -> Iterator[DatabaseManager]:
+        manager = self.acquire(dataset_id)
+        try:
+            yield manager
+        finally:
+            self.release(dataset_id)
+
+    def _get(self, dataset_id: str, lease: bool) -> DatabaseManager:
+        with self.lock:
+            entry = self.entries.get(dataset_id)
+            if entry is None:
+                entry = self.entries[dataset_id] = _Entry()
+            self.entries.move_to_end(dataset_id)
+            entry.last_used = time.monotonic()
+            manager = entry.manager
+            if manager is not None and lease:
+                entry.leases += 1
+        if manager is not None:
+            return manager
+
+        with entry.lock:
+            if entry.manager is None:
+                try:
+                    manager = self.factory(dataset_id)
+                except Exception:
+                    with self.lock:
+                        if self.entries.get(dataset_id) is entry:
+                            del self.entries[dataset_id]
+                    raise
+                with self.lock:
+                    entry.manager = manager
+                logger.debug(f'registry: loaded {dataset_id}')
+            with self.lock:
+                manager = entry.manager
+                if lease:
+                    entry.leases += 1
+
+        self.evict(keep=dataset_id)
+        return manager
+
+    def remove(self, dataset_id: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(dataset_id, None)
+        if entry is not None:
+            with entry.lock:
+                if entry.manager is not None:
+                    entry.manager.close()
+                    entry.manager = None
+
+    def evict(self, keep: str = None) -> None:
+        '''Close idle managers, least recently used first, until within budget.'''
+        now = time.monotonic()
+        victims = []
+        with self.lock:
+            loaded = [(key, entry) for key, entry in self.entries.items() if entry.manager is not None]
+            total = sum(entry.manager.estimated_bytes() for _, entry in loaded) if self.max_bytes else 0
+            count = len(loaded)
+            for key, entry in loaded:
+                over_count = self.max_loaded is not None and count > self.max_loaded
+                over_bytes = self.max_bytes is not None and total > self.max_bytes
+                if not (over_count or over_bytes):
+                    break
+                if (
+                    key == keep or entry.leases or entry.manager.is_busy()
+                    or now - entry.last_used < self.idle_seconds
+                ):
+                    continue
+                # holding the entry lock until closed makes a concurrent `get`
+                # wait for the old manager to be gone before opening a new one.
+                if not entry.lock.acquire(blocking=False):
+                    continue
+                victims.append((key, entry.manager, entry))
+                entry.manager = None
+                count -= 1
+                if self.max_bytes:
+                    total -= victims[-1][1].estimated_bytes()
+
+        for key, manager, entry in victims:
+            try:
+                manager.close()
+                logger.info(f'registry: evicted {key}')
+            finally:
+                entry.lock.release()
+
+    def warm(self, dataset_ids: Iterable[str]) -> Thread:
+        '''Load and warm `dataset_ids` in the background.'''
+        def run():
+            for dataset_id in dataset_ids:
+                try:
+                    self.get(dataset_id).warm()
+                    logger.info(f'registry: warmed {dataset_id}')
+                except Exception as warm_error:
+                    logger.warning(f'{dataset_id}: {warm_error=}')
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self) -> None:
+        with self.lock:
+            dataset_ids = list(self.entries)
+        for dataset_id in dataset_ids:
+            self.remove(dataset_id)
@@ -0,0 +1,61 @@
+from gunicorn.app.base import BaseApplication
+import hydra
+import logging
+import multiprocessing
+from omegaconf import DictConfig, OmegaConf
+from typing import Dict
+
+from tapestry.app import make_app
+from tapestry.index import run_indexer
+
+logger = logging.getLogger(__name__)
+
+class TapestryApplication(BaseApplication):
+    '''Gunicorn application that builds one serving-only app per worker.'''
+    def __init__(self, config: Dict, options: Dict):
+        self.config = config
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        cfg = OmegaConf.create(self.config)
+        cfg.server.index_owner = False
+        return make_app(cfg)
+
+@hydra.main(version_base=None, config_path='config', config_name='app')
+def main(cfg: DictConfig):
+    '''Serve with gunicorn workers, while a single child process does all indexing.'''
+    # hydra's resolvers are unavailable in child processes, so resolve up front.
+    config = OmegaConf.to_container(cfg, resolve=True)
+
+    # not a daemon, since it starts its own process pool for image preprocessing.
+    indexer = multiprocessing.get_context('spawn').Process(
+        target=run_indexer,
+        args=(config,),
+        name='tapestry-indexer',
+        daemon=False,
+    )
+    indexer.start()
+
+    options = dict(
+        bind=f'{cfg.server.host}:{cfg.server.port}',
+        workers=cfg.server.workers,
+        threads=cfg.server.threads,
+        worker_class='gthread',
+        timeout=max(30, cfg.timeout * 3),
+    )
+    try:
+        TapestryApplication(config, options).run()
+    finally:
+        indexer.terminate()
+        indexer.join(timeout=10)
+        if indexer.is_alive():
+            indexer.kill()
+            indexer.join()
+
+if __name__ == '__main__':
+    main()
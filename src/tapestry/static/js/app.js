@@ -10,6 +10,7 @@ const state = {
   dragIntent: null,
   draggedIndex: null,
   totalImages: 0,
+  nextCursor: null,
   imagesPerPage: 100,
   currentDataset: null,
   activeCollection: null
@@ -129,6 +130,8 @@ async function handleDatasetChange(datasetId) {
 
     state.currentDataset = datasetId;
     resetPagination();
+    processingStatusRetry = STATUS_RETRY_MIN;
+    watchProcessingStatus();
     await loadImages();
 }
 
@@ -178,6 +181,7 @@ function resetPagination() {
     state.hasMore = true;
     state.allImageData = [];
     state.totalImages = 0;
+    state.nextCursor = null;
 }
 
 function getImageUrl(image) {
@@ -223,13 +227,15 @@ async function handleDragOver(e, index) {
 
     displayResults(newImages);
 
-    const positions = newImages.map((item, idx) => ({
-        path: item.path || item.filename,
-        position: idx
-    }));
+    const pathOf = (item) => item && (item.path || item.filename);
+    const move = {
+        path: pathOf(draggedItem),
+        after: pathOf(newImages[index - 1]) || null,
+        before: pathOf(newImages[index + 1]) || null
+    };
 
     try {
-        await updateCollectionOrder(positions);
+        await moveCollectionImage(move);
     } catch (error) {
         console.error('Error updating collection order:', error);
         await loadImages();
@@ -256,7 +262,15 @@ function displayResults(results, append = false) {
         const globalIndex = append ? state.allImageData.length - results.length + index : index;
 
         const img = document.createElement('img');
-        img.src = getImageUrl(result);
+        if (result.thumbnails) {
+            // Let the browser pick the smallest thumbnail that fills a grid cell.
+            const sizes = Object.keys(result.thumbnails).map(Number).sort((a, b) => a - b);
+            img.srcset = sizes.map(size => `${result.thumbnails[size]} ${size}w`).join(', ');
+            img.sizes = `${Math.ceil(100 / state.gridWidth)}vw`;
+            img.src = result.thumbnails[sizes[sizes.length - 1]];
+        } else {
+            img.src = getImageUrl(result);
+        }
         img.alt = result.filename || result.path;
         img.loading = 'lazy';
         img.className = 'w-full h-full object-cover';
@@ -305,9 +319,18 @@ async function loadImages(page = 1, append = false) {
     elements.loadingIndicator.style.display = 'block';
 
     try {
-        let url = state.activeCollection
-            ? `/collections/${state.activeCollection}`
-            : `/get-all-images?dataset_id=${state.currentDataset}&page=${page}&per_page=${state.imagesPerPage}`;
+        const pageParam = append && state.nextCursor !== null
+            ? `cursor=${state.nextCursor}`
+            : `page=${page}`;
+        let url;
+        if (state.activeCollection) {
+            const cursorParam = append && state.nextCursor !== null
+                ? `&cursor=${encodeURIComponent(state.nextCursor)}`
+                : '';
+            url = `/collections/${state.activeCollection}?per_page=${state.imagesPerPage}${cursorParam}`;
+        } else {
+            url = `/get-all-images?dataset_id=${state.currentDataset}&${pageParam}&per_page=${state.imagesPerPage}`;
+        }
 
         const response = await fetch(url);
         const data = await response.json();
@@ -320,10 +343,10 @@ async function loadImages(page = 1, append = false) {
         let processedImages;
         if (state.activeCollection) {
             processedImages = (data.images || []).map(img => ({
-                path: img.path,
-                filename: img.path.split('/').pop(),
+                ...img,
+                filename: img.filename || img.path.split('/').pop(),
                 prompt: img.prompt || img.filename || img.path,
-                url: window.utils.getImageUrl(img)
+                url: img.url || window.utils.getImageUrl(img)
             }));
         } else {
             processedImages = (data.images || []).map(img => ({
@@ -342,7 +365,8 @@ async function loadImages(page = 1, append = false) {
 
         displayResults(processedImages, append);
 
-        state.hasMore = state.allImageData.length < state.totalImages;
+        state.nextCursor = data.next_cursor ?? null;
+        state.hasMore = data.has_more ?? state.allImageData.length < state.totalImages;
 
         if (data.processing_status) {
             updateProcessingStatus(data.processing_status);
@@ -591,22 +615,22 @@ async function addImageToCollection(imagePath) {
     }
 }
 
-async function updateCollectionOrder(positions) {
+async function moveCollectionImage(move) {
     if (!state.activeCollection) return;
 
     try {
-        const response = await fetch(`/collections/${state.activeCollection}/positions`, {
+        const response = await fetch(`/collections/${state.activeCollection}/move`, {
             method: 'PATCH',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ positions })
+            body: JSON.stringify(move)
         });
 
         if (!response.ok) {
             const errorData = await response.json();
-            throw new Error(errorData.error || 'Failed to update positions');
+            throw new Error(errorData.error || 'Failed to move image');
         }
     } catch (error) {
-        console.error('Error updating collection order:', error);
+        console.error('Error moving collection image:', error);
         await loadImages();
     }
 }
@@ -694,34 +718,84 @@ elements.dropZone.addEventListener('click', () => {
     elements.fileInput.click();
 });
 
+function formatDuration(seconds) {
+    const minutes = Math.floor(seconds / 60);
+    const rest = String(Math.round(seconds % 60)).padStart(2, '0');
+    return minutes >= 60
+        ? `${Math.floor(minutes / 60)}:${String(minutes % 60).padStart(2, '0')}:${rest}`
+        : `${minutes}:${rest}`;
+}
+
 function updateProcessingStatus(status) {
     if (status.is_processing) {
+        const parts = [`Processing: ${status.processed_count}/${status.total_count}`];
+        if (status.throughput) {
+            parts.push(`${status.throughput.toFixed(1)} images/s`);
+        }
+        if (status.eta_seconds != null) {
+            parts.push(`ETA ${formatDuration(status.eta_seconds)}`);
+        }
+        if (status.error_count) {
+            parts.push(`${status.error_count} failed batch${status.error_count === 1 ? '' : 'es'}`);
+        }
         elements.processingStatus.style.display = 'block';
-        elements.processingStatus.textContent =
-            `Processing: ${status.processed_count}/${status.total_count}`;
+        elements.processingStatus.textContent = parts.join(' · ');
+        const lastError = status.errors?.[status.errors.length - 1];
+        elements.processingStatus.title = lastError ? lastError.message : '';
+        if (!processingStatusSource) {
+            watchProcessingStatus();
+        }
     } else {
         elements.processingStatus.style.display = 'none';
     }
 }
 
-async function pollProcessingStatus() {
-    if (!state.currentDataset) return;
+// idle datasets are checked again after a delay that doubles up to the maximum.
+const STATUS_RETRY_MIN = 5000;
+const STATUS_RETRY_MAX = 60000;
+let processingStatusSource = null;
+let processingStatusTimer = null;
+let processingStatusRetry = STATUS_RETRY_MIN;
+
+function stopWatchingProcessingStatus() {
+    if (processingStatusSource) {
+        processingStatusSource.close();
+        processingStatusSource = null;
+    }
+    clearTimeout(processingStatusTimer);
+    processingStatusTimer = null;
+}
 
-    try {
-        const response = await fetch(`/processing-status?dataset_id=${state.currentDataset}`);
-        if (!response.ok) {
-            throw new Error('Failed to fetch processing status.');
-        }
+function scheduleProcessingStatus() {
+    processingStatusTimer = setTimeout(watchProcessingStatus, processingStatusRetry);
+    processingStatusRetry = Math.min(processingStatusRetry * 2, STATUS_RETRY_MAX);
+}
 
-        const status = await response.json();
-        updateProcessingStatus(status);
+function watchProcessingStatus() {
+    // the server pushes changes while the dataset is processing and ends
+    // the stream once it's idle.
+    stopWatchingProcessingStatus();
+    if (!state.currentDataset) return;
 
+    const source = new EventSource(
+        `/processing-status/stream?dataset_id=${encodeURIComponent(state.currentDataset)}`
+    );
+    processingStatusSource = source;
+    source.onmessage = (event) => {
+        const status = JSON.parse(event.data);
+        updateProcessingStatus(status);
         if (status.is_processing) {
-            setTimeout(pollProcessingStatus, 2000);
+            processingStatusRetry = STATUS_RETRY_MIN;
+            return;
         }
-    } catch (error) {
-        console.error('Error polling status:', error);
-    }
+        stopWatchingProcessingStatus();
+        scheduleProcessingStatus();
+    };
+    source.onerror = (error) => {
+        console.error('Error streaming status:', error);
+        stopWatchingProcessingStatus();
+        scheduleProcessingStatus();
+    };
 }
 
 let scrollTimeout = null;
@@ -751,7 +825,7 @@ window.addEventListener('dragoperationend', () => {
 window.addEventListener('load', () => {
     initializeCollectionsSidebar();
     loadImages();
-    pollProcessingStatus();
+    watchProcessingStatus();
 });
 
 window.state = state;
@@ -768,5 +842,5 @@ window.addEventListener('DOMContentLoaded', () => {
   initializeCollectionsSidebar();
   updateGridLayout();
   loadImages();
-  pollProcessingStatus();
+  watchProcessingStatus();
 });
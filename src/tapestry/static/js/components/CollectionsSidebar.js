@@ -398,24 +398,16 @@ const CollectionsSidebar = ({ onCollectionSelect, activeCollection }) => {
                                     style: styles.menuItem
                                 }, '🗑️ Delete'),
                                 React.createElement('button', {
-                                    onClick: async (e) => {
+                                    onClick: (e) => {
                                         e.stopPropagation();
-                                        try {
-                                            const response = await fetch(`/collections/${collection.id}/export`);
-                                            if (response.ok) {
-                                                const blob = await response.blob();
-                                                const url = window.URL.createObjectURL(blob);
-                                                const a = document.createElement('a');
-                                                a.href = url;
-                                                a.download = `${collection.name}.zip`;
-                                                document.body.appendChild(a);
-                                                a.click();
-                                                window.URL.revokeObjectURL(url);
-                                                document.body.removeChild(a);
-                                            }
-                                        } catch (error) {
-                                            console.error('Error exporting collection:', error);
-                                        }
+                                        // link straight to the streamed archive so the browser
+                                        // writes it to disk instead of buffering a blob.
+                                        const a = document.createElement('a');
+                                        a.href = `/collections/${collection.id}/export`;
+                                        a.download = `${collection.name}.zip`;
+                                        document.body.appendChild(a);
+                                        a.click();
+                                        document.body.removeChild(a);
                                     },
                                     style: styles.menuItem
                                 }, '📤 Export')
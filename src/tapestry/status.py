@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+STATUS_COLUMNS = ('is_processing', 'processed_count', 'total_count', 'generation')
+
+class StatusStore:
+    '''Processing status shared between the indexing process and web workers.
+
+    The process that owns indexing publishes each dataset's status and
+    index generation, and web workers read them back or queue sync requests
+    for the indexer to pick up.
+    '''
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.init_db()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def init_db(self):
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS datasets (
+                    dataset_id TEXT PRIMARY KEY,
+                    is_processing INTEGER NOT NULL DEFAULT 0,
+                    processed_count INTEGER NOT NULL DEFAULT 0,
+                    total_count INTEGER NOT NULL DEFAULT 0,
+                    generation INTEGER NOT NULL DEFAULT 0,
+                    sync_requested INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL
+                )
+            ''')
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(datasets)')}
+            if 'progress' not in columns:
+                # throughput, eta and recent errors, as json.
+                cursor.execute('ALTER TABLE datasets ADD COLUMN progress TEXT')
+            conn.commit()
+
+    def publish(self, dataset_id: str, status: Dict, bump: bool = False) -> None:
+        '''Store `status`, and with `bump` mark the dataset's index as changed.'''
+        with self.connect() as conn:
+            conn.execute(
+                '''
+                INSERT INTO datasets (dataset_id, is_processing, processed_count, total_count, progress, generation, updated_at)
+                VALUES (:dataset_id, :is_processing, :processed_count, :total_count, :progress, :generation, :updated_at)
+                ON CONFLICT(dataset_id) DO UPDATE SET
+                    is_processing = excluded.is_processing,
+                    processed_count = excluded.processed_count,
+                    total_count = excluded.total_count,
+                    progress = excluded.progress,
+                    generation = CASE WHEN :bump THEN excluded.generation ELSE datasets.generation END,
+                    updated_at = excluded.updated_at
+                ''',
+                dict(
+                    dataset_id=dataset_id,
+                    is_processing=int(bool(status['is_processing'])),
+                    processed_count=status['processed_count'],
+                    total_count=status['total_count'],
+                    progress=json.dumps({key: value for key, value in status.items() if key not in STATUS_COLUMNS}),
+                    generation=time.time_ns(),
+                    updated_at=time.time(),
+                    bump=int(bump),
+                )
+            )
+            conn.commit()
+
+    def get(self, dataset_id: str) -> Optional[Dict]:
+        with self.connect() as conn:
+            row = conn.execute(
+                '''
+                SELECT is_processing, processed_count, total_count, generation, progress
+                FROM datasets WHERE dataset_id = ?
+                ''',
+                (dataset_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(
+            json.loads(row[4] or '{}'),
+            is_processing=bool(row[0]),
+            processed_count=row[1],
+            total_count=row[2],
+            generation=row[3],
+        )
+
+    def request_sync(self, dataset_id: str) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                '''
+                INSERT INTO datasets (dataset_id, sync_requested, updated_at) VALUES (?, 1, ?)
+                ON CONFLICT(dataset_id) DO UPDATE SET sync_requested = 1
+                ''',
+                (dataset_id, time.time())
+            )
+            conn.commit()
+
+    def take_sync_requests(self) -> List[str]:
+        '''Return and clear the datasets that have a pending sync request.'''
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT dataset_id FROM datasets WHERE sync_requested = 1')
+            dataset_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute('UPDATE datasets SET sync_requested = 0 WHERE sync_requested = 1')
+            conn.commit()
+        return dataset_ids
+
+    def remove(self, dataset_id: str) -> None:
+        with self.connect() as conn:
+            conn.execute('DELETE FROM datasets WHERE dataset_id = ?', (dataset_id,))
+            conn.commit()
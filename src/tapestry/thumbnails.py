@@ -0,0 +1,80 @@
+from concurrent.futures import Executor
+import logging
+import os
+from os.path import exists, join
+from PIL import Image, ImageOps
+from typing import Callable, Dict, List, Tuple
+
+from tapestry.cache import hash_file
+
+logger = logging.getLogger(__name__)
+
+def thumbnail_name(digest: str, size: int) -> str:
+    return f'{digest[:2]}/{digest}_{size}.webp'
+
+def thumbnail_urls(digest: str, sizes: List[int], dataset_id: str) -> Dict[str, str]:
+    return {
+        str(size): f'/thumbnails/{thumbnail_name(digest, size)}?dataset_id={dataset_id}'
+        for size in sizes
+    }
+
+class ThumbnailCache:
+    '''WebP thumbnails for one dataset, keyed by the content hash of the source.
+
+    Names only depend on the file bytes, so thumbnail urls never change
+    meaning and can be cached by browsers indefinitely.
+    '''
+    def __init__(
+        self,
+        folder: str,
+        sizes: List[int],
+        quality: int = 80,
+        executor: Executor = None,
+    ):
+        self.folder = folder
+        self.sizes = sorted(int(size) for size in sizes)
+        self.quality = quality
+        self.executor = executor
+        os.makedirs(self.folder, exist_ok=True)
+
+    def generate(self, image_path: str) -> str:
+        '''Create any missing thumbnails for `image_path` and return its digest.'''
+        digest = hash_file(image_path).hex()
+        pending = [
+            size for size in self.sizes
+            if not exists(join(self.folder, thumbnail_name(digest, size)))
+        ]
+        if not pending:
+            return digest
+
+        os.makedirs(join(self.folder, digest[:2]), exist_ok=True)
+        with Image.open(image_path) as image:
+            image.draft('RGB', (pending[-1], pending[-1]))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            # shrink from the largest size down, each step starting from the last.
+            for size in reversed(pending):
+                image.thumbnail((size, size), Image.Resampling.LANCZOS)
+                output_path = join(self.folder, thumbnail_name(digest, size))
+                image.save(f'{output_path}.tmp', format='WEBP', quality=self.quality)
+                os.replace(f'{output_path}.tmp', output_path)
+        return digest
+
+    def submit(self, image_paths: List[str], on_done: Callable[[List[Tuple[str, str]]], None]) -> None:
+        '''Generate thumbnails in the background, then report (digest, path) pairs.'''
+        def run():
+            digests = []
+            for image_path in image_paths:
+                try:
+                    digests.append((self.generate(image_path), image_path))
+                except Exception as thumbnail_error:
+                    logger.warning(f'{image_path}: {thumbnail_error=}')
+            if digests:
+                on_done(digests)
+
+        if self.executor is None:
+            run()
+        else:
+            self.executor.submit(run)
+
+    def urls(self, digest: str, dataset_id: str) -> Dict[str, str]:
+        return thumbnail_urls(digest, self.sizes, dataset_id)
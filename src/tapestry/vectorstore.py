@@ -0,0 +1,577 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+import hashlib
+import heapq
+from itertools import islice
+import json
+import logging
+import numpy as np
+import os
+from os.path import exists, getsize, join
+import sqlite3
+from threading import RLock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def write_rows(path: str, rows: List[int], data: np.ndarray, row_bytes: int) -> None:
+    '''Write each row of `data` at its row offset, growing the file as needed.'''
+    if not exists(path):
+        open(path, 'wb').close()
+    with open(path, 'r+b') as output_file:
+        for row, values in zip(rows, data):
+            output_file.seek(row * row_bytes)
+            output_file.write(values.tobytes())
+
+class NumpyCollection:
+    '''Exact brute-force vector store exposing the subset of the Chroma
+    collection api that `DatabaseManager` relies on.
+
+    Vectors live in a flat `vectors.<dtype>` file that is scanned through a
+    memory map, and ids, documents and metadata live in `rows.db`, where
+    `row` is the vector's position in the file. Rows freed by `delete` are
+    reused by later inserts.
+
+    With `quantization` set, queries scan a compact float16 or int8 copy
+    (`codes.<quantization>`, plus per-row scales for int8) and re-rank the
+    best `rerank_factor * k` candidates against the full-precision vectors,
+    which then only need to be paged in for those candidates.
+    '''
+    def __init__(
+        self,
+        path: str,
+        name: str,
+        dimension: int,
+        metadata: Dict[str, Any] = None,
+        embedding_function: Callable[[List[str]], List[np.ndarray]] = None,
+        dtype: str = 'float32',
+        quantization: str = None,
+        rerank_factor: int = 4,
+        chunk_size: int = 65536,
+    ):
+        self.path = path
+        self.name = name
+        self.dimension = dimension
+        self.metadata = metadata or {}
+        self.space = self.metadata.get('hnsw:space', 'l2')
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.rerank_factor = max(1, rerank_factor)
+        self.chunk_size = chunk_size
+        self.row_bytes = self.dimension * self.dtype.itemsize
+        self.vectors_path = join(self.path, f'vectors.{self.dtype.name}')
+        self.rows_path = join(self.path, 'rows.db')
+        if self.quantization not in (None, 'float16', 'int8'):
+            raise ValueError(f'{quantization=}')
+        if self.quantization:
+            self.code_dtype = np.dtype(self.quantization)
+            self.code_bytes = self.dimension * self.code_dtype.itemsize
+            self.codes_path = join(self.path, f'codes.{self.quantization}')
+            self.scales_path = join(self.path, 'scales.float32')
+        self.lock = RLock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self.init_db()
+        self.load()
+
+    def init_db(self):
+        with sqlite3.connect(self.rows_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rows (
+                    row INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    document TEXT,
+                    metadata TEXT
+                )
+            ''')
+            conn.commit()
+
+    def load(self) -> None:
+        with sqlite3.connect(self.rows_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT row, id, document, metadata FROM rows')
+            stored = cursor.fetchall()
+
+        vector_rows = getsize(self.vectors_path) // self.row_bytes if exists(self.vectors_path) else 0
+        self.n_rows = max([vector_rows] + [row + 1 for row, *_ in stored])
+        self.ids: List[Optional[str]] = [None] * self.n_rows
+        self.documents: List[Optional[str]] = [None] * self.n_rows
+        self.metadatas: List[Optional[Dict]] = [None] * self.n_rows
+        self.alive = np.zeros(self.n_rows, dtype=bool)
+        self.rows: Dict[str, int] = {}
+        self.where_index: Dict[str, Dict[Any, set]] = {}
+
+        for row, file_id, document, metadata in stored:
+            self.ids[row] = file_id
+            self.documents[row] = document
+            self.metadatas[row] = json.loads(metadata) if metadata else None
+            self.alive[row] = True
+            self.rows[file_id] = row
+
+        self.free_rows = [row for row in range(self.n_rows) if not self.alive[row]]
+        self.matrix = None
+        self.codes = None
+        self.scales = None
+
+        if self.quantization:
+            code_rows = getsize(self.codes_path) // self.code_bytes if exists(self.codes_path) else 0
+            if code_rows < self.n_rows:
+                self.build_codes()
+        logger.debug(f'numpy collection {self.name}: {len(self.rows)} vectors')
+
+    def _matrix(self) -> Optional[np.memmap]:
+        if self.matrix is None and self.n_rows:
+            self.matrix = np.memmap(
+                self.vectors_path,
+                dtype=self.dtype,
+                mode='r',
+                shape=(self.n_rows, self.dimension),
+            )
+        return self.matrix
+
+    def _codes(self) -> Optional[np.memmap]:
+        if self.codes is None and self.n_rows:
+            self.codes = np.memmap(
+                self.codes_path,
+                dtype=self.code_dtype,
+                mode='r',
+                shape=(self.n_rows, self.dimension),
+            )
+            if self.quantization == 'int8':
+                self.scales = np.memmap(self.scales_path, dtype=np.float32, mode='r', shape=(self.n_rows,))
+        return self.codes
+
+    def quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        '''Compress vectors to codes, with symmetric per-row scales for int8.'''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.quantization == 'float16':
+            return vectors.astype(np.float16), None
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def build_codes(self) -> None:
+        '''Rebuild the compressed copy from the full-precision vectors.'''
+        logger.info(f'numpy collection {self.name}: building {self.quantization} codes')
+        matrix = self._matrix()
+        with open(self.codes_path, 'wb') as codes_file, open(self.scales_path, 'wb') as scales_file:
+            for start in range(0, self.n_rows, self.chunk_size):
+                codes, scales = self.quantize(matrix[start:start + self.chunk_size])
+                codes_file.write(codes.tobytes())
+                if scales is not None:
+                    scales_file.write(scales.tobytes())
+        self.codes = None
+
+    def read_vectors(self, rows, compressed: bool = False) -> np.ndarray:
+        if not compressed:
+            return np.asarray(self._matrix()[rows], dtype=np.float32)
+        vectors = np.asarray(self._codes()[rows], dtype=np.float32)
+        if self.quantization == 'int8':
+            vectors *= np.asarray(self.scales[rows], dtype=np.float32)[:, None]
+        return vectors
+
+    def _prepare(self, embeddings) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        if self.space == 'cosine':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def _rows_where(self, where: Dict[str, Any]) -> set:
+        rows = None
+        for key, condition in where.items():
+            if key not in self.where_index:
+                index: Dict[Any, set] = {}
+                for row in np.flatnonzero(self.alive):
+                    value = (self.metadatas[row] or {}).get(key)
+                    index.setdefault(value, set()).add(int(row))
+                self.where_index[key] = index
+            index = self.where_index[key]
+
+            if isinstance(condition, dict) and '$in' in condition:
+                matched = set().union(*(index.get(value, set()) for value in condition['$in']))
+            elif isinstance(condition, dict) and '$eq' in condition:
+                matched = set(index.get(condition['$eq'], set()))
+            else:
+                matched = set(index.get(condition, set()))
+            rows = matched if rows is None else rows & matched
+        return rows or set()
+
+    def _index_row(self, row: int, add: bool) -> None:
+        metadata = self.metadatas[row] or {}
+        for key, index in self.where_index.items():
+            rows = index.setdefault(metadata.get(key), set())
+            if add:
+                rows.add(row)
+            else:
+                rows.discard(row)
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: List[np.ndarray] = None,
+        metadatas: List[Dict] = None,
+        documents: List[str] = None,
+    ) -> None:
+        if embeddings is None:
+            embeddings = self.embedding_function(documents)
+        vectors = self._prepare(embeddings).astype(self.dtype)
+        if len(vectors) != len(ids):
+            raise ValueError(f'{len(ids)} ids but {len(vectors)} embeddings.')
+        metadatas = metadatas or [None] * len(ids)
+        documents = documents or [None] * len(ids)
+
+        with self.lock:
+            duplicates = [file_id for file_id in ids if file_id in self.rows]
+            if duplicates:
+                raise ValueError(f'ids already exist: {duplicates[:5]}')
+
+            rows = []
+            for _ in vectors:
+                row = self.free_rows.pop() if self.free_rows else self.n_rows
+                if row == self.n_rows:
+                    self.n_rows += 1
+                rows.append(row)
+
+            write_rows(self.vectors_path, rows, vectors, self.row_bytes)
+            if self.quantization:
+                codes, scales = self.quantize(vectors)
+                write_rows(self.codes_path, rows, codes, self.code_bytes)
+                if scales is not None:
+                    write_rows(self.scales_path, rows, scales, scales.itemsize)
+
+            with sqlite3.connect(self.rows_path) as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    'INSERT INTO rows (row, id, document, metadata) VALUES (?, ?, ?, ?)',
+                    [
+                        (row, file_id, document, json.dumps(metadata) if metadata is not None else None)
+                        for row, file_id, document, metadata in zip(rows, ids, documents, metadatas)
+                    ]
+                )
+                conn.commit()
+
+            grow = self.n_rows - len(self.ids)
+            if grow > 0:
+                self.ids.extend([None] * grow)
+                self.documents.extend([None] * grow)
+                self.metadatas.extend([None] * grow)
+                self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+
+            for row, file_id, document, metadata in zip(rows, ids, documents, metadatas):
+                self.ids[row] = file_id
+                self.documents[row] = document
+                self.metadatas[row] = metadata
+                self.alive[row] = True
+                self.rows[file_id] = row
+                self._index_row(row, add=True)
+            self.matrix = None
+            self.codes = None
+
+    def delete(self, ids: List[str] = None, where: Dict[str, Any] = None) -> None:
+        with self.lock:
+            rows = {self.rows[file_id] for file_id in ids or [] if file_id in self.rows}
+            if where:
+                rows |= self._rows_where(where)
+            if not rows:
+                return
+
+            with sqlite3.connect(self.rows_path) as conn:
+                cursor = conn.cursor()
+                cursor.executemany('DELETE FROM rows WHERE row = ?', [(row,) for row in rows])
+                conn.commit()
+
+            for row in rows:
+                self._index_row(row, add=False)
+                del self.rows[self.ids[row]]
+                self.ids[row] = self.documents[row] = self.metadatas[row] = None
+                self.alive[row] = False
+                self.free_rows.append(row)
+
+    def get(
+        self,
+        ids: List[str] = None,
+        where: Dict[str, Any] = None,
+        limit: int = None,
+        offset: int = None,
+        include: List[str] = ['metadatas', 'documents'],
+    ) -> Dict[str, Any]:
+        with self.lock:
+            if ids is not None:
+                rows = [self.rows[file_id] for file_id in ids if file_id in self.rows]
+                if where:
+                    matched = self._rows_where(where)
+                    rows = [row for row in rows if row in matched]
+            elif where:
+                rows = sorted(self._rows_where(where))
+            else:
+                rows = [int(row) for row in np.flatnonzero(self.alive)]
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+
+            result = dict(ids=[self.ids[row] for row in rows], embeddings=None, documents=None, metadatas=None)
+            if 'documents' in include:
+                result['documents'] = [self.documents[row] for row in rows]
+            if 'metadatas' in include:
+                result['metadatas'] = [self.metadatas[row] for row in rows]
+            if 'embeddings' in include:
+                matrix = self._matrix()
+                result['embeddings'] = np.asarray(
+                    matrix[rows] if rows else np.empty((0, self.dimension)), dtype=np.float32
+                )
+            return result
+
+    def distances(self, queries: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        similarity = queries @ vectors.T
+        if self.space == 'l2':
+            return (
+                np.sum(queries ** 2, axis=1, keepdims=True)
+                - 2 * similarity
+                + np.sum(vectors ** 2, axis=1)[None, :]
+            )
+        return 1.0 - similarity
+
+    def scan(
+        self,
+        queries: np.ndarray,
+        k: int,
+        alive: np.ndarray,
+        compressed: bool,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        '''Chunked top-k scan, keeping only each chunk's best k per query.'''
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(alive), self.chunk_size):
+            stop = min(start + self.chunk_size, len(alive))
+            distances = self.distances(queries, self.read_vectors(slice(start, stop), compressed))
+            distances[:, ~alive[start:stop]] = np.inf
+            chunk_k = min(k, stop - start)
+            top = np.argpartition(distances, chunk_k - 1, axis=1)[:, :chunk_k]
+            best_distances = np.concatenate(
+                [best_distances, np.take_along_axis(distances, top, axis=1)], axis=1
+            )
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+            if best_distances.shape[1] > k:
+                keep = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                best_distances = np.take_along_axis(best_distances, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        return best_rows, best_distances
+
+    def query(
+        self,
+        query_embeddings: List[np.ndarray] = None,
+        query_texts: List[str] = None,
+        n_results: int = 10,
+        include: List[str] = ['metadatas', 'documents', 'distances'],
+        where: Dict[str, Any] = None,
+    ) -> Dict[str, Any]:
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+        queries = self._prepare(query_embeddings)
+
+        with self.lock:
+            n_rows, alive = self.n_rows, self.alive.copy()
+            if where:
+                allowed = np.zeros(n_rows, dtype=bool)
+                allowed[list(self._rows_where(where))] = True
+                alive &= allowed
+            matrix = self._matrix()
+
+        k = min(n_results or 10, int(alive.sum()))
+        result = dict(ids=[], distances=[], documents=[], metadatas=[], embeddings=None)
+        if matrix is None or k == 0:
+            for key in ('ids', 'distances', 'documents', 'metadatas'):
+                result[key] = [[] for _ in queries]
+            return result
+
+        candidates = k * self.rerank_factor if self.quantization else k
+        best_rows, best_distances = self.scan(
+            queries, min(candidates, int(alive.sum())), alive, compressed=bool(self.quantization)
+        )
+
+        ranked = []
+        for query, rows, distances in zip(queries, best_rows, best_distances):
+            rows = rows[np.isfinite(distances)]
+            if self.quantization:
+                # re-rank the candidates against the full-precision vectors.
+                rows = np.sort(rows)
+                distances = self.distances(query[None, :], self.read_vectors(rows))[0]
+            else:
+                distances = distances[np.isfinite(distances)]
+            order = np.argsort(distances)[:k]
+            ranked.append((rows[order], distances[order]))
+
+        with self.lock:
+            for rows, distances in ranked:
+                rows = [int(row) for row in rows]
+                result['ids'].append([self.ids[row] for row in rows])
+                result['distances'].append([float(distance) for distance in distances])
+                result['documents'].append([self.documents[row] for row in rows])
+                result['metadatas'].append([self.metadatas[row] for row in rows])
+        return result
+
+def shard_of(file_id: str, n_shards: int) -> int:
+    '''Stable shard assignment for an id, independent of process and run.'''
+    return int.from_bytes(hashlib.blake2b(file_id.encode(), digest_size=8).digest(), 'big') % n_shards
+
+class ShardedCollection:
+    '''Spread one dataset over several collections, routed by a hash of the id.
+
+    Writes go to the owning shard, while queries and metadata filters fan
+    out to every shard in parallel and are merged by distance. Without a
+    shared `executor` the collection starts its own, which `close` stops.
+    '''
+    def __init__(
+        self,
+        shards: List[Any],
+        embedding_function: Callable[[List[str]], List[np.ndarray]] = None,
+        executor: Executor = None,
+    ):
+        self.shards = shards
+        self.embedding_function = embedding_function
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=len(shards),
+            thread_name_prefix='shards',
+        )
+
+    def close(self) -> None:
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def shard_for(self, file_id: str) -> int:
+        return shard_of(file_id, len(self.shards))
+
+    def _fan_out(self, call: Callable[[int], Any], shards: List[int] = None) -> List[Any]:
+        '''Run `call(shard_index)` for every (or the given) shard in parallel.'''
+        shards = range(len(self.shards)) if shards is None else shards
+        return list(self.executor.map(call, shards))
+
+    def _group(self, ids: List[str], *columns) -> Dict[int, List[tuple]]:
+        groups: Dict[int, List[tuple]] = {}
+        for row in zip(ids, *columns):
+            groups.setdefault(self.shard_for(row[0]), []).append(row)
+        return groups
+
+    def count(self) -> int:
+        return sum(self._fan_out(lambda shard: self.shards[shard].count()))
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: List[np.ndarray] = None,
+        metadatas: List[Dict] = None,
+        documents: List[str] = None,
+    ) -> None:
+        n = len(ids)
+        groups = self._group(
+            ids,
+            embeddings if embeddings is not None else [None] * n,
+            metadatas or [None] * n,
+            documents or [None] * n,
+        )
+
+        def add_group(shard: int) -> None:
+            group_ids, group_embeddings, group_metadatas, group_documents = zip(*groups[shard])
+            self.shards[shard].add(
+                ids=list(group_ids),
+                embeddings=list(group_embeddings) if embeddings is not None else None,
+                metadatas=list(group_metadatas) if metadatas is not None else None,
+                documents=list(group_documents) if documents is not None else None,
+            )
+
+        self._fan_out(add_group, list(groups))
+
+    def delete(self, ids: List[str] = None, where: Dict[str, Any] = None) -> None:
+        if ids:
+            groups = self._group(ids)
+            self._fan_out(
+                lambda shard: self.shards[shard].delete(ids=[row[0] for row in groups[shard]]),
+                list(groups),
+            )
+        if where:
+            self._fan_out(lambda shard: self.shards[shard].delete(where=where))
+
+    def get(
+        self,
+        ids: List[str] = None,
+        where: Dict[str, Any] = None,
+        limit: int = None,
+        offset: int = None,
+        include: List[str] = ['metadatas', 'documents'],
+    ) -> Dict[str, Any]:
+        if ids is not None:
+            groups = self._group(ids)
+            parts = self._fan_out(
+                lambda shard: self.shards[shard].get(
+                    ids=[row[0] for row in groups[shard]],
+                    where=where,
+                    include=include,
+                ),
+                list(groups),
+            )
+        else:
+            parts = self._fan_out(
+                lambda shard: self.shards[shard].get(where=where, include=include)
+            )
+
+        result = dict(ids=[], embeddings=None, documents=None, metadatas=None)
+        for key in ('documents', 'metadatas'):
+            if key in include:
+                result[key] = []
+        embeddings = []
+        for part in parts:
+            result['ids'].extend(part['ids'])
+            for key in ('documents', 'metadatas'):
+                if key in include:
+                    result[key].extend(part[key] or [])
+            if 'embeddings' in include and part['embeddings'] is not None and len(part['embeddings']):
+                embeddings.append(np.asarray(part['embeddings'], dtype=np.float32))
+
+        start = offset or 0
+        stop = None if limit is None else start + limit
+        for key in ('ids', 'documents', 'metadatas'):
+            if result[key] is not None:
+                result[key] = result[key][start:stop]
+        if 'embeddings' in include:
+            stacked = np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+            result['embeddings'] = stacked[start:stop]
+        return result
+
+    def query(
+        self,
+        query_embeddings: List[np.ndarray] = None,
+        query_texts: List[str] = None,
+        n_results: int = 10,
+        include: List[str] = ['metadatas', 'documents', 'distances'],
+        where: Dict[str, Any] = None,
+    ) -> Dict[str, Any]:
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+
+        def query_shard(shard):
+            kwargs = dict(query_embeddings=query_embeddings, n_results=n_results, include=include)
+            if where:
+                kwargs['where'] = where
+            if self.shards[shard].count() == 0:
+                return None
+            return self.shards[shard].query(**kwargs)
+
+        parts = [part for part in self._fan_out(query_shard) if part is not None]
+        result = dict(ids=[], distances=[], documents=[], metadatas=[], embeddings=None)
+        for q in range(len(query_embeddings)):
+            streams = [
+                zip(part['distances'][q], part['ids'][q], part['documents'][q], part['metadatas'][q])
+                for part in parts
+            ]
+            merged = list(islice(heapq.merge(*streams, key=lambda row: row[0]), n_results))
+            result['distances'].append([row[0] for row in merged])
+            result['ids'].append([row[1] for row in merged])
+            result['documents'].append([row[2] for row in merged])
+            result['metadatas'].append([row[3] for row in merged])
+        return result
@@ -0,0 +1,22 @@
+from tapestry.status import StatusStore
+
+STATUS = dict(is_processing=False, processed_count=3, total_count=3)
+
+def test_publish_without_bump_keeps_generation(tmp_path):
+    store = StatusStore(str(tmp_path / 'status.db'))
+    store.publish('photos', STATUS, bump=True)
+    generation = store.get('photos')['generation']
+
+    store.publish('photos', dict(STATUS, processed_count=1), bump=False)
+    store.publish('photos', STATUS, bump=False)
+
+    assert store.get('photos')['generation'] == generation
+
+def test_publish_with_bump_moves_generation(tmp_path):
+    store = StatusStore(str(tmp_path / 'status.db'))
+    store.publish('photos', STATUS, bump=True)
+    generation = store.get('photos')['generation']
+
+    store.publish('photos', STATUS, bump=True)
+
+    assert store.get('photos')['generation'] != generation